@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+
+'''
+benchmarks of hal9000 and detect.py without a network
+fakebin/nmap and fakebin/ping stand in for the real tools, see their
+docstrings for latency, loss and port density settings
+posix only: the fakes are extensionless python scripts found through
+PATH; windows finds neither that way, and takes its own ping.exe from
+system32 before PATH anyway
+
+python benchmark.py [hosts]
+
+'''
+
+import hal9000
+import detect
+import os
+import io
+import sys
+import random
+import tempfile
+import contextlib
+import multiprocessing
+import threading
+try:
+    import resource #posix only
+except ImportError:
+    resource = None
+
+FAKEBIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakebin')
+
+##############################################################################
+
+
+def _tempdb():
+    '''
+    fresh MyDB on a temporary file, MyDB creates the tables
+
+    '''
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.remove(path)
+    return hal9000.MyDB(path), path
+
+
+def _dropdb(mydb, path):
+    '''
+    close and remove a temporary MyDB with its WAL files
+
+    '''
+
+    mydb.conn.close()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def _host_records(count, seed=0):
+    '''
+    ping-like host records as con_ping writes them
+
+    '''
+
+    rnd = random.Random(seed)
+    now = int(hal9000.time.time())
+    return [{'ip': '10.%d.%d.%d' %(i >> 16 & 255, i >> 8 & 255, i & 255),
+        'stat': rnd.choice(('up', 'down')),
+        'timestamp': now} for i in range(count)]
+
+
+def _service_records(count, seed=0):
+    '''
+    port-scan-like service records as non_scan_ports_tcp writes them
+
+    '''
+
+    rnd = random.Random(seed)
+    return [{'ip': '10.%d.%d.%d' %(i >> 16 & 255, i >> 8 & 255, i & 255),
+        'portid': rnd.choice((22, 80, 135, 443, 445, 3389)),
+        'protocol': 'tcp',
+        'state': 'open'} for i in range(count)]
+
+
+def _timeit(func, *args):
+    start = hal9000.time.perf_counter()
+    func(*args)
+    return hal9000.time.perf_counter() - start
+
+
+def bench_mydb(count=10000):
+    '''
+    per-row update_*_record against bulk_update_* on the same records
+    each path writes twice: first pass inserts, second pass merges
+
+    '''
+
+    for name, records in (('host', _host_records(count)),
+            ('service', _service_records(count))):
+        mydb, path = _tempdb()
+        single = mydb.update_host_record if name == 'host' \
+            else mydb.update_service_record
+        elapsed = 0
+        for _ in range(2):
+            elapsed += _timeit(lambda: [single(rec) for rec in records])
+        print('%-8s per-row : %8.0f records/s' %(name, 2 * count / elapsed))
+        _dropdb(mydb, path)
+
+        mydb, path = _tempdb()
+        bulk = mydb.bulk_update_hosts if name == 'host' \
+            else mydb.bulk_update_services
+        elapsed = _timeit(bulk, records) + _timeit(bulk, records)
+        print('%-8s bulk    : %8.0f records/s' %(name, 2 * count / elapsed))
+        _dropdb(mydb, path)
+
+##############################################################################
+
+
+class Report:
+    '''
+    latency samples per stage, printed as percentiles
+
+    '''
+
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, func, *args, **kwargs):
+        start = hal9000.time.perf_counter()
+        result = func(*args, **kwargs)
+        self.add(stage, hal9000.time.perf_counter() - start)
+        return result
+
+    def add(self, stage, seconds):
+        self.stages.setdefault(stage, []).append(seconds)
+
+    def percentile(self, values, pct):
+        values = sorted(values)
+        return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+    def show(self):
+        print('%-28s %6s %9s %9s %9s' %('stage', 'n', 'p50 ms', 'p90 ms',
+            'p99 ms'))
+        for stage, values in self.stages.items():
+            print('%-28s %6d %9.2f %9.2f %9.2f' %(stage, len(values),
+                1000 * self.percentile(values, 50),
+                1000 * self.percentile(values, 90),
+                1000 * self.percentile(values, 99)))
+
+
+def gen_assets(count, filename='asset.lst', first='10.0.0.0'):
+    '''
+    synthetic asset file of /24 networks holding about count hosts
+    1k to 1M hosts are 4 to 3938 lines
+    return: list of networks
+
+    '''
+
+    base = int(hal9000.ipaddress.IPv4Address(first))
+    netlist = ['%s/24' %(hal9000.ipaddress.IPv4Address(base + 256 * i))
+        for i in range(max(1, -(-count // 254)))]
+    with open(filename, 'w') as fp:
+        fp.write('\n'.join(netlist) + '\n')
+    return netlist
+
+
+def peak_rss():
+    '''
+    peak resident memory of this process and its children in MB
+    None where the resource module is missing
+
+    '''
+
+    if resource is None:
+        return None
+    scale = 1024.0 * 1024 if sys.platform == 'darwin' else 1024.0
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale
+
+
+@contextlib.contextmanager
+def sandbox(count, quiet=True):
+    '''
+    run inside a temporary directory with a synthetic asset.lst, a fresh
+    hal9000.db and fakebin first in PATH; stdout is dropped if quiet
+
+    '''
+
+    cwd = os.getcwd()
+    path = os.environ.get('PATH', '')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmpdir)
+        os.environ['PATH'] = FAKEBIN + os.pathsep + path
+        gen_assets(count)
+        if quiet:
+            with open(os.devnull, 'w') as devnull:
+                with contextlib.redirect_stdout(devnull):
+                    yield tmpdir
+        else:
+            yield tmpdir
+    finally:
+        os.chdir(cwd)
+        os.environ['PATH'] = path
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+
+def bench_drivers(count=1000):
+    '''
+    end-to-end throughput of the detect.py drivers against fakebin
+    every driver runs in the same sandbox, con_scan_os after the pings
+    rows/s counts host rows each driver wrote
+
+    '''
+
+    drivers = (('con_ping', detect.con_ping,
+            'SELECT COUNT(*) FROM host WHERE timestamp>=(?)'),
+        ('async_ping', detect.async_ping,
+            'SELECT COUNT(*) FROM host WHERE timestamp>=(?)'),
+        ('con_discover', detect.con_discover,
+            'SELECT COUNT(*) FROM host WHERE timestamp>=(?)'),
+        ('con_scan_os', detect.con_scan_os,
+            'SELECT COUNT(*) FROM host WHERE osname IS NOT NULL AND (?)>0'))
+    lines = []
+    with sandbox(count):
+        hosts = len(hal9000.Targets(hal9000.Asset().iterlist('asset.lst')))
+        mydb = hal9000.MyDB()
+        for name, driver, written in drivers:
+            since = int(hal9000.time.time()) + 1 #rows of this driver only
+            hal9000.time.sleep(since - hal9000.time.time())
+            start = hal9000.time.perf_counter()
+            driver()
+            elapsed = hal9000.time.perf_counter() - start
+            rows = mydb.cursor.execute(written, (since,)).fetchone()[0]
+            lines.append((name, elapsed, rows, peak_rss()))
+
+    print('%-14s %9s %10s %10s %10s' %('driver', 'seconds', 'hosts/s',
+        'rows/s', 'peak MB'))
+    for name, elapsed, rows, rss in lines:
+        print('%-14s %9.2f %10.0f %10.0f %10s' %(name, elapsed,
+            hosts / elapsed, rows / elapsed,
+            '-' if rss is None else '%.0f' %(rss)))
+
+
+def bench_loops(count=1000, seconds=10):
+    '''
+    throughput of the non_* queue drivers, each one alone for seconds in
+    a process of its own, against the queue seeded from one ping sweep
+    jobs/s counts the jobs it finished, read from the tables it writes
+
+    '''
+
+    loops = (('non_ping', detect.non_ping, {'budget': 10 ** 6},
+            'SELECT COUNT(*) FROM host WHERE timestamp>=(?)'),
+        ('non_scan_ports_tcp top', detect.non_scan_ports_tcp,
+            {'tier': 'top'}, 'SELECT COUNT(*) FROM portchunk \
+            WHERE chunk=-1 AND checked>=(?)'),
+        ('non_scan_ports_tcp chunks', detect.non_scan_ports_tcp,
+            {'tier': 'chunks'}, 'SELECT COUNT(*) FROM portchunk \
+            WHERE chunk>=0 AND checked>=(?)'),
+        ('non_scan_service_tcp', detect.non_scan_service_tcp, {},
+            'SELECT COUNT(DISTINCT ip) FROM service WHERE timestamp>=(?)'))
+    lines = []
+    with sandbox(count):
+        detect.async_ping()
+        mydb = hal9000.MyDB()
+        for name, loop, kwargs, done in loops:
+            since = int(hal9000.time.time()) + 1
+            hal9000.time.sleep(since - hal9000.time.time())
+            proc = multiprocessing.Process(target=loop, kwargs=kwargs)
+            start = hal9000.time.perf_counter()
+            proc.start()
+            proc.join(seconds)
+            proc.terminate()
+            proc.join()
+            elapsed = hal9000.time.perf_counter() - start
+            jobs = mydb.cursor.execute(done, (since,)).fetchone()[0]
+            lines.append((name, elapsed, jobs))
+        mydb.conn.close()
+
+    print('%-26s %9s %8s %8s' %('loop', 'seconds', 'jobs', 'jobs/s'))
+    for name, elapsed, jobs in lines:
+        print('%-26s %9.2f %8d %8.1f' %(name, elapsed, jobs, jobs / elapsed))
+
+
+def bench_cluster(count=1000, workers=3, kill=True):
+    '''
+    detect.coordinator with worker processes on localhost
+    kill: stop one worker halfway so its shard has to be reassigned
+
+    '''
+
+    with sandbox(count):
+        procs = [multiprocessing.Process(target=detect.worker,
+            args=('127.0.0.1', 9900)) for _ in range(workers)]
+        for proc in procs:
+            proc.start()
+        if kill:
+            killer = threading.Timer(2, procs[0].terminate)
+            killer.start()
+        start = hal9000.time.perf_counter()
+        coordinator = hal9000.Coordinator(hal9000.MyDB(), 'ping',
+            hal9000.Coordinator.shard_subnets(
+                list(hal9000.Asset().iterlist('asset.lst'))), 9900)
+        records = coordinator.run()
+        elapsed = hal9000.time.perf_counter() - start
+        for proc in procs:
+            proc.join()
+        mydb = hal9000.MyDB()
+        hosts = mydb.cursor.execute('SELECT COUNT(*) FROM host').fetchone()[0]
+        mydb.conn.close()
+    print('cluster: %d workers, %d hosts, %d records, %d reassigned, '
+        '%.0f hosts/s' %(workers, hosts, records, coordinator.reassigned,
+        hosts / elapsed))
+
+
+def bench_stages(count=1000, samples=50):
+    '''
+    latency percentiles of single stages: probes, xml parsing, db writes
+    and job queue round-trips
+
+    '''
+
+    report = Report()
+    with sandbox(count):
+        targets = hal9000.Targets(hal9000.Asset().iterlist('asset.lst'))
+        iplist = list(targets)[:samples]
+        ping = hal9000.Ping()
+        scanner = hal9000.Scanner()
+        for ip in iplist:
+            report.time('ping', ping.win_ping, ip)
+            report.time('nmap ports (1 host)', scanner.scan_ports_tcp, ip)
+        for i in range(0, len(iplist), 16):
+            report.time('nmap os (16 hosts)', scanner.scan_os_batch,
+                iplist[i:i + 16])
+
+        output = hal9000.subprocess.check_output(
+            scanner.cmd_ports(hal9000.Asset().getlist('asset.lst')).split())
+        for _ in range(5):
+            report.time('parse ports (%d hosts)' %(len(targets)), list,
+                scanner.parse_ports(scanner._iterparse(io.BytesIO(output),
+                scanner.TAGS['ports'])))
+
+        mydb = hal9000.MyDB()
+        records = _host_records(count)
+        for i in range(0, count, 200):
+            report.time('db bulk write (200)', mydb.bulk_update_hosts,
+                records[i:i + 200])
+        for record in records[:samples]:
+            report.time('db update_host_record', mydb.update_host_record,
+                record)
+
+        queue = hal9000.JobQueue(mydb)
+        queue.seed('ping')
+        for _ in range(samples):
+            jobs = report.time('queue claim (10)', queue.claim, 'ping', 10)
+            report.time('queue complete (10)', queue.complete, 'ping', jobs)
+    report.show()
+
+def bench_state(count=1000000, samples=5):
+    '''
+    HostState over about count hosts: fill from hal9000.db, save, mmap
+    load, full diff and per /24 counts against a second sweep
+
+    '''
+
+    report = Report()
+    with sandbox(count):
+        targets = hal9000.Targets(hal9000.Asset().iterlist('asset.lst'))
+        mydb = hal9000.MyDB()
+        records = _host_records(len(targets))
+        for record, ip in zip(records, targets):
+            record['ip'] = ip
+        mydb.bulk_update_hosts(records)
+        older = report.time('fill from db (%d hosts)' %(len(targets)),
+            hal9000.HostState(targets.ranges).fill, mydb)
+        report.time('save', older.save, 'older.bin')
+        mydb.bulk_update_hosts([dict(record, stat='up')
+            for record in records[::10]]) #the second sweep
+        hal9000.HostState(targets.ranges).fill(mydb).save('newer.bin')
+        for _ in range(samples):
+            older = report.time('load (mmap)', hal9000.HostState.load,
+                'older.bin')
+            newer = hal9000.HostState.load('newer.bin')
+            report.time('diff', newer.diff, older)
+            report.time('count per /24', newer.count)
+            report.time('up now, not before', lambda:
+                bin(newer.bits('up') & ~older.bits('up')).count('1'))
+    report.show()
+
+##############################################################################
+
+if __name__ == '__main__':
+    hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    bench_mydb(hosts)
+    bench_stages(hosts)
+    bench_drivers(hosts)
+    bench_loops(hosts)
+    bench_cluster(hosts)
+    bench_state(max(hosts, 100000))
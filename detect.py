@@ -2,114 +2,559 @@
 
 import hal9000
 from multiprocessing import Pool, Process
+from functools import partial
+import threading
+
+_warm = {} #Ping and Scanner of one Pool process, made by its first task
 
 ##############################################################################
 
 
-def con_ping():
+def export_metrics(export=None):
+    '''
+    turn hal9000.metrics on and export them
+    export: port number to serve /metrics on, or textfile name rewritten
+    every 15s for node_exporter, None keeps metrics off
+
+    '''
+
+    if export is None:
+        return
+    hal9000.metrics.enable()
+    if type(export) is int:
+        hal9000.metrics.serve(export)
+    else:
+        hal9000.metrics.write(export, 15)
+
+def _mydb():
+    '''
+    MyDB that fills dept and admin from the owners named in asset.lst
+
+    '''
+
+    return hal9000.MyDB(owners=hal9000.Owners.load('asset.lst'))
+
+def con_ping(exclude=None, fresh=0, resume=True):
     '''
     concurrent ping
+    exclude: file of networks or ranges not to ping, same format as asset.lst
+    fresh: skip ips pinged by any run within fresh seconds
+    resume: go on with the last interrupted run, see progress('ping')
     runtime estimate: 15m
 
     '''
 
-    addrlist = hal9000.Asset().getlist('asset.lst')
-    ipaddr = hal9000.SplitIpAddr().split(addrlist)
+    excludelist = []
+    if exclude is not None:
+        excludelist = hal9000.Asset().iterlist(exclude)
+    targets = hal9000.Targets(
+        hal9000.Asset().iterlist('asset.lst'), excludelist)
+    print('%d targets' %(len(targets)))
 
-    mydb = hal9000.MyDB()
-    ping = hal9000.Ping()
+    mydb = _mydb()
+    checkpoint = hal9000.Checkpoint(mydb, 'ping', fresh, resume)
+    print('Run %s' %(checkpoint.start(len(targets))))
+    first = int(checkpoint.cursor or 0) #batches done before a crash
+
+    writer = hal9000.BatchWriter(checkpoint.writer(mydb.bulk_update_hosts))
 
     pool = Pool(240) #240 is prefered
 
-    results = []
-    for ip in ipaddr:
-        results.append(pool.apply_async(ping.win_ping, args=(ip,)))
+    for number, batch in enumerate(targets.batches(4096)): #bounds the queue
+        if number < first:
+            continue
+        for result in writer.follow(pool.imap_unordered(_ping,
+                checkpoint.pending(batch), 16)):
+            if result is not None: #hung ping, left for the next run
+                writer.add(([result], [result['ip']]))
+            print('Wrote %s' %(result))
+        writer.flush()
+        checkpoint.save(number + 1)
     pool.close()
     pool.join()
+    checkpoint.finish()
+
+    print('All done.')
+
+def con_discover(method='icmp', groupsize=8, poolsize=4):
+    '''
+    concurrent host discovery, whole networks per nmap -sn run
+    method: icmp, arp, tcp or all, see Scanner.DISCOVER
+    groupsize: asset.lst lines passed to one nmap process
+    poolsize: nmap processes running at the same time
+
+    '''
+
+    netlist = list(hal9000.Asset().iterlist('asset.lst'))
+    groups = []
+    for i in range(0, len(netlist), groupsize):
+        groups.append(netlist[i:i + groupsize])
+
+    mydb = _mydb()
+    scanner = hal9000.Scanner()
+    writer = hal9000.BatchWriter(mydb.bulk_update_hosts, 1000)
 
-    for result in results:
-        mydb.update_host_record(result.get())
-        print('Wrote %s' %(result.get()))
+    pool = Pool(poolsize)
+
+    for result in writer.follow(pool.imap_unordered(
+            partial(scanner.discover, method=method), groups)):
+        writer.add(result)
+        print('Wrote %d records' %(len(result)))
+    pool.close()
+    pool.join()
+    writer.flush()
 
     print('All done.')
 
-def non_ping():
+def async_ping(concurrency=1000, exclude=None, adaptive=True, pps=None,
+        subnetpps=None):
     '''
-    non-current ping
-    
+    concurrent ping from one process by asyncio subprocesses
+    concurrency: pings running at the same time, the most if adaptive
+    adaptive: start low and let latency and timeouts settle the limit
+    pps, subnetpps: packets per second caps, global and per /24
+
     '''
 
-    mydb = hal9000.MyDB()
+    excludelist = []
+    if exclude is not None:
+        excludelist = hal9000.Asset().iterlist(exclude)
+    targets = hal9000.Targets(
+        hal9000.Asset().iterlist('asset.lst'), excludelist)
+    print('%d targets' %(len(targets)))
+
+    mydb = _mydb()
+    writer = hal9000.BatchWriter(mydb.bulk_update_hosts)
+
+    runner = hal9000.AsyncRunner({'ping': concurrency}, adaptive=adaptive,
+        pps=pps, subnetpps=subnetpps)
+    runner.run('ping', targets, writer.add)
+    writer.flush()
+
+    print('All done, %d timeouts, limit settled at %d.' %(runner.timeouts,
+        runner.throttle.limit))
+
+def non_ping(batch=10, budget=180, metrics=None):
+    '''
+    non-current ping, any number of them may share the db
+    batch: jobs claimed per round-trip
+    budget: pings per hour of this worker, 180 is the former 20s wait
+    metrics: see export_metrics()
+
+    '''
+
+    export_metrics(metrics)
+
+    mydb = _mydb()
+    queue = hal9000.JobQueue(mydb)
+    scheduler = hal9000.Scheduler(mydb, 'ping', budget=budget)
     ping = hal9000.Ping()
 
+    queue.enqueue('ping', hal9000.Targets(hal9000.Asset().iterlist('asset.lst')))
     while True:
-        ip = mydb.get_host_oldest_timestamp()
-        result = ping.win_ping(ip[0])
-        mydb.update_host_record(result)
-        print('Delibrately wait 20s ...')
-        hal9000.time.sleep(20)
+        jobs = queue.claim('ping', batch)
+        if len(jobs) == 0:
+            queue.seed('ping')
+            hal9000.time.sleep(20)
+        for ip in jobs:
+            scheduler.pace()
+            stat = mydb.get_host_stat(ip)
+            result = ping.win_ping(ip)
+            if result is None: #ping hung, try again later
+                queue.fail('ping', ip, 'timeout')
+                continue
+            mydb.update_host_record(result)
+            queue.complete('ping', ip,
+                scheduler.observe(ip, stat != result['stat']))
+            if stat != 'up' and result['stat'] == 'up': #newly up
+                queue.expedite('topports', ip)
+                queue.expedite('ports', ip)
+            queue.heartbeat('ping', jobs)
 
-def con_scan_os():
+def con_scan_os(groupsize=16, poolsize=10, fresh=0, resume=True):
     '''
     should run after ping() since it scans only active ip.
-    runtime estimate: 4h
-    
+    groupsize: ips passed to one nmap process, 1 means one nmap per ip
+    poolsize: nmap processes running at the same time
+    fresh: skip ips scanned by any run within fresh seconds
+    resume: go on with the last interrupted run, see progress('os')
+    runtime estimate: 4h with groupsize=1, poolsize=10
+
     '''
 
-    mydb = hal9000.MyDB()
-    ipaddr = mydb.get_host_all_active()
+    mydb = _mydb()
+    quarantine = hal9000.Quarantine(mydb)
+    ipaddr = quarantine.filter('os',
+        [ip[0] for ip in mydb.get_host_all_active()])
+    checkpoint = hal9000.Checkpoint(mydb, 'os', fresh, resume)
+    print('Run %s' %(checkpoint.start(len(ipaddr))))
+    ipaddr = list(checkpoint.pending(ipaddr))
 
-    scanner = hal9000.Scanner()
+    hal9000.Scanner() #checks nmap once, Pool processes inherit it
 
-    pool = Pool(10) #10 is preferd
-    
-    results = []
-    for ip in ipaddr:
-        results.append(pool.apply_async(scanner.scan_os, args=(ip[0],)))
+    pool = Pool(poolsize)
+
+    groups = []
+    for i in range(0, len(ipaddr), groupsize):
+        groups.append(ipaddr[i:i + groupsize])
+
+    writer = hal9000.BatchWriter(checkpoint.writer(mydb.bulk_update_hosts),
+        max(1, 50 // groupsize), 30) #about 50 records
+
+    for group, result, timedout in writer.follow(
+            pool.imap_unordered(_scan_os_group, groups)):
+        writer.add((result, [ip for ip in group if ip not in timedout]))
+        quarantine.strike('os', timedout)
+        quarantine.clear('os', [record['ip'] for record in result])
+        for record in result:
+            print('Wrote %s' %(record))
     pool.close()
     pool.join()
-    
-    for result in results:
-        mydb.update_host_record(result.get())
-        print('Wrote %s' %(result.get()))
+    writer.flush()
+    checkpoint.finish()
 
     print('All done.')
-    
-def non_scan_ports_tcp():
+
+def _ping(ip):
+    '''
+    Pool task of con_ping
+
+    '''
+
+    if 'ping' not in _warm:
+        _warm['ping'] = hal9000.Ping()
+    return _warm['ping'].win_ping(ip)
+
+def _scan_os_group(group):
+    '''
+    Pool task of con_scan_os
+    return: (group, records, timed out ips)
+
+    '''
+
+    if 'scanner' not in _warm:
+        _warm['scanner'] = hal9000.Scanner()
+    scanner = _warm['scanner']
+    return group, scanner.scan_os_batch(group), scanner.take_timedout()
+
+def progress(kind='os'):
+    '''
+    progress and eta of the last con_ping ('ping') or con_scan_os ('os')
+
+    '''
+
+    state = hal9000.Checkpoint(hal9000.MyDB(), kind).progress()
+    if state is None:
+        print('No run of %s.' %(kind))
+        return
+    print('Run %s: %s of %s done' %(state['run'], state['done'],
+        state['total']))
+    if state['finished'] is not None:
+        print('Finished at %s.' %(hal9000.time.ctime(state['finished'])))
+    elif state['eta'] is not None:
+        print('%.1f targets/s, eta %s.' %(state['rate'],
+            hal9000.time.ctime(state['updated'] + state['eta'])))
+
+def non_scan_ports_tcp(budget=None, metrics=None, tier='chunks', chunks=16,
+        close=False):
     '''
     should run after ping() because it scans only active ip.
+    any number of them may share the db, and run either tier.
+    budget: port scans per hour of this worker, None is unlimited
+    metrics: see export_metrics()
+    tier: 'top' scans Scanner.TOPPORTS ports, every 10m to 1d per host;
+    'chunks' scans the stalest of chunks parts of 1-65535 per job, so all
+    ports come round every 1h to 30d; chunks=1 is the former full sweep
+    close: mark open ports of the scanned chunk that no longer answer
+    as closed, the top tier leaves them to the chunks
     
     '''
 
-    mydb = hal9000.MyDB()
+    export_metrics(metrics)
+
+    mydb = _mydb()
+    queue = hal9000.JobQueue(mydb)
+    if tier == 'top':
+        kind = 'topports'
+        scheduler = hal9000.Scheduler(mydb, kind, 600, 86400, budget)
+    else: #interval of a whole rotation, grows a bit per chunk
+        kind = 'ports'
+        scheduler = hal9000.Scheduler(mydb, kind, 3600, 30 * 86400, budget,
+            2.0 ** (1.0 / chunks))
+    quarantine = hal9000.Quarantine(mydb)
     scanner = hal9000.Scanner()
 
     while True:
-        ip = mydb.get_host_oldest_portchktime_active()
-        result = scanner.scan_ports_tcp(ip[0])
-        if result is not None:
-            for record in result:
-                mydb.update_service_record(record)
+        jobs = queue.claim(kind)
+        if len(jobs) == 0:
+            if queue.seed(kind) == 0:
+                hal9000.time.sleep(20)
+            continue
+        ip = jobs[0]
+        listed = quarantine.listed(kind)
+        if ip in listed: #keeps timing out, put aside
+            queue.complete(kind, ip, listed[ip])
+            continue
+        if tier == 'top':
+            number, ports = -1, 'top'
+        else:
+            checked = mydb.get_port_chunks(ip, chunks)
+            number = min(range(chunks), key=lambda n: checked.get(n, 0))
+            ports = scanner.chunk(number, chunks)
+        scheduler.pace()
+        before = mydb.get_service_tcp_open_ports(ip)
+        after = set()
+        writer = hal9000.BatchWriter(mydb.bulk_update_services)
+        with queue.keepalive(kind, jobs): #a full sweep may outlast the lease
+            for record in scanner.iter_ports_tcp([ip], ports):
+                writer.add(record)
+                after.add(record['portid'])
                 print('Done with %s' %(record))
-        rec = {'ip': ip[0], 'portchktime': int(hal9000.time.time())}
-        mydb.update_host_record(rec)
-        print('Done with %s' %(rec))
+        writer.flush()
+        if len(scanner.take_timedout()) > 0: #partial result, retry later
+            quarantine.strike(kind, [ip])
+            queue.fail(kind, ip, 'timeout')
+            continue
+        quarantine.clear(kind, [ip])
+        now = int(hal9000.time.time())
+        if tier == 'top': #nmap's list, only new open ports are sure
+            changed = not after <= before
+        else: #opened or closed within the chunk
+            first, last = [int(port) for port in ports.split('-')]
+            scanned = set([port for port in before if first <= port <= last])
+            changed = after != scanned
+            if close:
+                mydb.bulk_update_services([{'ip': ip, 'portid': port,
+                    'protocol': 'tcp', 'state': 'closed', 'timestamp': now}
+                    for port in scanned - after])
+        mydb.set_port_chunk(ip, number, chunks, now)
+        due = scheduler.observe(ip, changed, now)
+        if tier != 'top': #one chunk of the rotation
+            due = now + (due - now) // chunks
+        queue.complete(kind, ip, due)
+        print('Done with %s chunk %d' %(ip, number))
 
-def non_scan_service_tcp():
+def non_scan_service_tcp(batch=4, metrics=None, ttl=7*86400):
     '''
     should run after scan_ports_tcp() because it scans only active ports.
+    any number of them may share the db.
+    batch: hosts claimed and scanned by one nmap, all stale ports at once
+    metrics: see export_metrics()
+    ttl: seconds a -sV result is reused while the port's banner digest
+    matches, see hal9000.FingerprintCache; 0 probes every port
 
     '''
 
-    mydb = hal9000.MyDB()
+    export_metrics(metrics)
+
+    mydb = _mydb()
+    queue = hal9000.JobQueue(mydb)
+    quarantine = hal9000.Quarantine(mydb)
     scanner = hal9000.Scanner()
+    cache = hal9000.FingerprintCache(ttl)
+    while True:
+        jobs = queue.claim('service', batch)
+        if len(jobs) == 0:
+            if queue.seed('service') == 0:
+                hal9000.time.sleep(20)
+            continue
+        listed = quarantine.listed('service')
+        for ip in jobs:
+            if ip in listed: #keeps timing out, put aside
+                queue.complete('service', ip, listed[ip])
+        jobs = [ip for ip in jobs if ip not in listed]
+        targets = {}
+        for ip in jobs:
+            ports = mydb.get_service_tcp_stale_ports(ip)
+            if len(ports) > 0:
+                targets[ip] = ports
+        digests = cache.digests(targets) if ttl > 0 else {}
+        now = int(hal9000.time.time())
+        reused = []
+        probe = {}
+        for ip, ports in targets.items():
+            for port in ports:
+                fields = cache.lookup(ip, port, digests.get((ip, port)), now)
+                if fields is None:
+                    probe.setdefault(ip, []).append(port)
+                else:
+                    fields.update({'ip': ip, 'portid': port,
+                        'protocol': 'tcp', 'state': 'open', 'timestamp': now})
+                    reused.append(fields)
+        with queue.keepalive('service', jobs): #-sV may outlast the lease
+            result = scanner.scan_services_tcp(probe)
+        for record in result:
+            if record.get('state') == 'open':
+                cache.store(record['ip'], record['portid'],
+                    digests.get((record['ip'], record['portid'])), record)
+        result.extend(reused)
+        mydb.bulk_update_services(result)
+        timedout = scanner.take_timedout()
+        done = set([record['ip'] for record in result]) - set(timedout)
+        quarantine.strike('service', timedout)
+        quarantine.clear('service', list(done))
+        queue.complete('service', [ip for ip in jobs if ip in done or ip not in targets])
+        queue.fail('service', [ip for ip in targets if ip not in done],
+            'host is down or timeout')
+        for record in result:
+            print(record)
+        stats = cache.stats()
+        print('Fingerprint cache: %d hits, %d misses, %d changed, '
+            '%d expired, %.0f%% hit rate' %(stats['hit'], stats['miss'],
+            stats['changed'], stats['expired'], 100 * stats['hitrate']))
+
+def coordinator(kind='ping', port=9900, shard='subnet', shards=64,
+        host='127.0.0.1', token=None):
+    '''
+    hand asset.lst to remote worker() processes and write what they find
+    kind: ping, discover, os or ports
+    shard: subnet gives one /24 per shard, hash spreads ips over shards
+    host: address to listen on, '0.0.0.0' for workers on other machines
+    token: shared secret the workers have to send, required with any
+    host other than loopback
+
+    '''
+
+    netlist = list(hal9000.Asset().iterlist('asset.lst'))
+    if kind in ('os', 'ports'): #only active ip
+        iplist = [ip[0] for ip in hal9000.MyDB().get_host_all_active()]
+        shardlist = hal9000.Coordinator.shard_hash(iplist, shards)
+    elif shard == 'hash':
+        shardlist = hal9000.Coordinator.shard_hash(
+            hal9000.Targets(netlist), shards)
+    else:
+        shardlist = hal9000.Coordinator.shard_subnets(netlist)
+
+    coordinator = hal9000.Coordinator(_mydb(), kind, shardlist, port, host,
+        token=token)
+    print('%d shards on port %d' %(len(shardlist), coordinator.port))
+    count = coordinator.run()
+    print('All done, %d records, %d shards reassigned, %d records dropped.'
+        %(count, coordinator.reassigned, coordinator.dropped))
+
+def worker(host='127.0.0.1', port=9900, token=None):
+    '''
+    run shards of a coordinator() on this machine until it is done
+    token: the coordinator's, if it was given one
+
+    '''
+
+    count = hal9000.Worker(token=token).run(host, port)
+    print('All done, %d shards.' %(count))
+
+def save_state(filename='hoststate.bin'):
+    '''
+    snapshot of up hosts and open ports of asset.lst, run after a sweep
+    and keep a copy per day or week for changes()
+
+    '''
+
+    state = hal9000.HostState(hal9000.Targets(
+        hal9000.Asset().iterlist('asset.lst')).ranges).fill(hal9000.MyDB())
+    state.save(filename)
+    print('Saved %d up hosts to %s.' %(bin(state.bits()).count('1'),
+        filename))
+
+def changes(older, newer='hoststate.bin', prefix=24):
+    '''
+    hosts that came up or went down between two save_state() snapshots,
+    and up hosts per /prefix network now
+
+    '''
+
+    older = hal9000.HostState.load(older)
+    newer = hal9000.HostState.load(newer)
+    came, went = newer.diff(older)
+    for ip in came:
+        print('up   %s' %(ip))
+    for ip in went:
+        print('down %s' %(ip))
+    for net, count in sorted(newer.count(prefix=prefix).items()):
+        print('%-18s %d' %(net, count))
+    print('%d came up, %d went down.' %(len(came), len(went)))
+
+def history(since=86400):
+    '''
+    changes of hosts and services in the last since seconds, from the
+    history MyDB keeps of every real change
+
+    '''
+
+    mydb = hal9000.MyDB()
+    start = int(hal9000.time.time()) - since
+    for table in ('host', 'service'):
+        for change in mydb.get_changes(start, table=table):
+            key = change['ip'] if table == 'host' else '%s %s/%s' %(
+                change['ip'], change['portid'], change['protocol'])
+            print('%s %-7s %-24s %s' %(hal9000.time.strftime('%m-%d %H:%M',
+                hal9000.time.localtime(change['at'])), table, key,
+                ', '.join(['%s %s->%s' %(col, old, new) for col, (old, new)
+                    in sorted(change['delta'].items())])))
+
+def inventory(port=9800, host='127.0.0.1'):
+    '''
+    serve hal9000.Inventory, read-only json queries for other tools,
+    until interrupted
+    curl 'http://127.0.0.1:9800/hosts?subnet=10.1.0.0/16&stat=up'
+
+    '''
+
+    hal9000.Inventory().serve(port, host)
+    print('Serving on %s:%d' %(host, port))
+    while True:
+        hal9000.time.sleep(3600)
+
+def load(filename, table='host'):
+    '''
+    merge a csv or json lines file into table, 'host' or 'service'
+    not-none values overwrite, see hal9000.Dump
+
+    '''
+
+    count = hal9000.Dump(_mydb(), table).load(filename)
+    print('Merged %d %s records' %(count, table))
+
+def dump(filename, table='host', resume=True):
+    '''
+    export table, 'host' or 'service', to a csv or json lines file
+    resume: go on with an unfinished file instead of starting over
+
+    '''
+
+    count = hal9000.Dump(hal9000.MyDB(), table).dump(filename, resume)
+    print('Wrote %d %s records' %(count, table))
+
+def daemon(port=9700, loops=None, limits=None, metrics=None):
+    '''
+    one long-lived process for queue jobs and ad-hoc jobs
+    loops: threads running each non_* driver on the job queue, default
+    {'ping': 2, 'topports': 1, 'ports': 1, 'service': 1}
+    limits: ad-hoc probes running at once per kind, see hal9000.Daemon
+    metrics: see export_metrics()
+    echo '{"kind": "ping", "targets": ["10.0.0.1"]}' | nc 127.0.0.1 9700
+
+    '''
+
+    export_metrics(metrics)
+
+    drivers = {'ping': (non_ping, {}),
+        'topports': (non_scan_ports_tcp, {'tier': 'top'}),
+        'ports': (non_scan_ports_tcp, {'tier': 'chunks'}),
+        'service': (non_scan_service_tcp, {})}
+    if loops is None:
+        loops = {'ping': 2, 'topports': 1, 'ports': 1, 'service': 1}
+    for kind, count in loops.items():
+        driver, kwargs = drivers[kind]
+        for _ in range(count):
+            thread = threading.Thread(target=driver, kwargs=kwargs)
+            thread.daemon = True
+            thread.start()
+
+    hal9000.Daemon(owners=hal9000.Owners.load('asset.lst'),
+        limits=limits).serve(port)
+    print('Serving on 127.0.0.1:%d' %(port))
     while True:
-        record = mydb.get_service_tcp_oldest_timestamp_active()
-        mydb.cursor.execute('UPDATE service SET timestamp=8888888888 WHERE ip="'+str(record[0])+'" and portid='+str(record[1]))
-        mydb.conn.commit()
-        result = scanner.scan_service_tcp(record[0],record[1])
-        mydb.update_service_record(result)
-        print(result)
+        hal9000.time.sleep(3600)
 
 ##############################################################################
 
@@ -6,6 +6,27 @@ import ipaddress
 import subprocess
 import re
 import os
+import bisect
+import io
+import asyncio
+import socket
+import threading
+import http.server
+import socketserver
+import json
+import queue
+import zlib
+import signal
+import mmap
+import struct
+import array
+import heapq
+import collections
+import urllib.parse
+import multiprocessing.pool
+import csv
+import hmac
+import ctypes
 from xml.etree import ElementTree as ET
 
 ##############################################################################
@@ -14,6 +35,8 @@ from xml.etree import ElementTree as ET
 class Asset:
     '''
     get asset's ip from file.
+    a line is a network, optionally followed by its owner:
+    'cidr dept admin priority', '-' for none, see owners()
     
     '''
 
@@ -22,11 +45,54 @@ class Asset:
             fp = open(filename, 'r')
             list = []
             for line in fp.readlines():
-                list.append(line.strip('\n'))
+                fields = line.split()
+                list.append(fields[0] if len(fields) > 0 else '')
             return list
         except:
             raise MyExcept('Error: Get asset.')
 
+    def iterlist(self, filename):
+        '''
+        like getlist, but yields line by line
+        blank lines and lines starting with # are skipped
+
+        '''
+
+        for fields in self._iterfields(filename):
+            yield fields[0]
+
+    def owners(self, filename):
+        '''
+        yield (network, dept, admin, priority) of lines naming an owner
+        priority is an int, 0 if not given
+
+        '''
+
+        for fields in self._iterfields(filename):
+            if len(fields) < 2:
+                continue
+            fields = [None if field == '-' else field for field in fields]
+            fields += [None] * (4 - len(fields))
+            try:
+                priority = int(fields[3] or 0)
+            except ValueError:
+                raise MyExcept('Error: Priority of %s.' %(fields[0]))
+            yield fields[0], fields[1], fields[2], priority
+
+    def _iterfields(self, filename):
+
+        try:
+            fp = open(filename, 'r')
+        except:
+            raise MyExcept('Error: Get asset.')
+
+        with fp:
+            for line in fp:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                yield line.split()
+
 ##############################################################################
 
 
@@ -69,16 +135,322 @@ class CvrtTime:
 ##############################################################################
 
 
+class Metrics:
+    '''
+    counters, gauges and latency histograms of the hot paths
+    names get labels as keywords: metrics.inc('ping_total', stat='up')
+    off by default, then every call returns at once
+    export in prometheus text format by text(), write() or serve()
+    values are per process, workers of a Pool keep their own
+
+    '''
+
+    PREFIX = 'hal9000_'
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300,
+        900)
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None: #bucket counts, +Inf, sum
+                hist = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            hist[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            hist[-1] += seconds
+
+    def timer(self, name, **labels):
+        '''
+        context manager observing its duration into histogram name
+
+        '''
+
+        if not self.enabled:
+            return _NULLTIMER
+        return _Timer(self, name, labels)
+
+    def text(self):
+        '''
+        all values in prometheus text exposition format
+
+        '''
+
+        def labeled(name, labels, extra=()):
+            pairs = ['%s="%s"' %(k, v) for k, v in labels + tuple(extra)]
+            return self.PREFIX + name + ('{%s}' %(','.join(pairs)) if pairs else '')
+
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters),
+                    ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in typed:
+                        typed.add(name)
+                        lines.append('# TYPE %s%s %s' %(self.PREFIX, name, kind))
+                    lines.append('%s %s' %(labeled(name, labels), value))
+            typed = set()
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s%s histogram' %(self.PREFIX, name))
+                count = 0
+                for bound, hits in zip(self.BUCKETS + ('+Inf',), hist[:-1]):
+                    count += hits
+                    lines.append('%s %d' %(labeled(name + '_bucket', labels,
+                        (('le', bound),)), count))
+                lines.append('%s %s' %(labeled(name + '_sum', labels), hist[-1]))
+                lines.append('%s %d' %(labeled(name + '_count', labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, interval=None):
+        '''
+        write text() to filename atomically, for node_exporter textfile
+        interval: keep rewriting it every interval seconds from a thread
+
+        '''
+
+        with open(filename + '.tmp', 'w') as fp:
+            fp.write(self.text())
+        os.replace(filename + '.tmp', filename)
+        if interval is not None:
+            timer = threading.Timer(interval, self.write, (filename, interval))
+            timer.daemon = True
+            timer.start()
+
+    def serve(self, port=9100, host='127.0.0.1'):
+        '''
+        serve text() over http on a daemon thread
+        return: the http server
+
+        '''
+
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start,
+            **self.labels)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class _TimedReader:
+    '''
+    file wrapper adding up the time spent blocked in read()
+
+    '''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.waited = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.raw.read(size)
+        self.waited += time.perf_counter() - start
+        return data
+
+
+_NULLTIMER = _NullTimer()
+metrics = Metrics()
+
+##############################################################################
+
+
+class Schema:
+    '''
+    create and upgrade tables of my database by numbered migrations
+    the number of applied migrations is kept in PRAGMA user_version
+    only append new migrations, never edit applied ones
+
+    '''
+
+    MIGRATIONS = [
+        [   #1: base tables
+            'CREATE TABLE IF NOT EXISTS host(ip TEXT PRIMARY KEY, name TEXT, \
+                stat TEXT, osname TEXT, osvendor TEXT, osfamily TEXT, \
+                osgen TEXT, osaccuracy INTEGER, dept TEXT, admin TEXT, \
+                timestamp INTEGER, portchktime INTEGER, "desc" TEXT)',
+            'CREATE TABLE IF NOT EXISTS service(ip TEXT, portid INTEGER, \
+                protocol TEXT, state TEXT, reason TEXT, servname TEXT, \
+                product TEXT, version TEXT, dept TEXT, admin TEXT, \
+                timestamp INTEGER, "desc" TEXT, \
+                PRIMARY KEY(ip, portid, protocol))'],
+        [   #2: covering indexes for the scheduling queries
+            'CREATE INDEX IF NOT EXISTS host_stat_timestamp \
+                ON host(stat, timestamp, ip)',
+            'CREATE INDEX IF NOT EXISTS host_stat_portchktime \
+                ON host(stat, portchktime, ip)',
+            'CREATE INDEX IF NOT EXISTS host_timestamp ON host(timestamp, ip)',
+            'CREATE INDEX IF NOT EXISTS service_state_timestamp \
+                ON service(state, timestamp, ip, portid)'],
+        [   #3: job queue, see JobQueue
+            'CREATE TABLE IF NOT EXISTS job(kind TEXT, target TEXT, \
+                due INTEGER, owner TEXT, attempts INTEGER DEFAULT 0, \
+                error TEXT, PRIMARY KEY(kind, target))',
+            'CREATE INDEX IF NOT EXISTS job_kind_due ON job(kind, due)'],
+        [   #4: service jobs are per host now, seed them again
+            'DELETE FROM job WHERE kind=\'service\''],
+        [   #5: per target change statistics, see Scheduler
+            'CREATE TABLE IF NOT EXISTS volatility(kind TEXT, target TEXT, \
+                interval INTEGER, rate REAL, seen INTEGER, changed INTEGER, \
+                lastchange INTEGER, PRIMARY KEY(kind, target))'],
+        [   #6: targets that keep timing out, see Quarantine
+            'CREATE TABLE IF NOT EXISTS quarantine(kind TEXT, target TEXT, \
+                strikes INTEGER, until INTEGER, PRIMARY KEY(kind, target))'],
+        [   #7: resumable batch runs, see Checkpoint
+            'CREATE TABLE IF NOT EXISTS run(id TEXT PRIMARY KEY, kind TEXT, \
+                started INTEGER, updated INTEGER, finished INTEGER, \
+                total INTEGER, skipped INTEGER DEFAULT 0, cursor TEXT)',
+            'CREATE INDEX IF NOT EXISTS run_kind_started \
+                ON run(kind, started)',
+            'CREATE TABLE IF NOT EXISTS runtarget(kind TEXT, target TEXT, \
+                runid TEXT, done INTEGER, PRIMARY KEY(kind, target))',
+            'CREATE INDEX IF NOT EXISTS runtarget_runid_done \
+                ON runtarget(runid, done)'],
+        [   #8: check time per port chunk of a host, chunk -1 is top ports
+            'CREATE TABLE IF NOT EXISTS portchunk(ip TEXT, chunk INTEGER, \
+                checked INTEGER, PRIMARY KEY(ip, chunk))'],
+        [   #9: changed columns of host and service rows, see MyDB._delta
+            'CREATE TABLE IF NOT EXISTS host_history(ip TEXT, at INTEGER, \
+                delta TEXT)',
+            'CREATE INDEX IF NOT EXISTS host_history_ip_at \
+                ON host_history(ip, at)',
+            'CREATE INDEX IF NOT EXISTS host_history_at ON host_history(at)',
+            'CREATE TABLE IF NOT EXISTS service_history(ip TEXT, \
+                portid INTEGER, protocol TEXT, at INTEGER, delta TEXT)',
+            'CREATE INDEX IF NOT EXISTS service_history_ip_at \
+                ON service_history(ip, at)',
+            'CREATE INDEX IF NOT EXISTS service_history_at \
+                ON service_history(at)'],
+        [   #10: portchunk keyed by its layout too, chunk of chunks parts;
+            #    rotation rows of unknown layout are dropped, top ports kept
+            'CREATE TABLE IF NOT EXISTS portchunk_layout(ip TEXT, \
+                chunks INTEGER, chunk INTEGER, checked INTEGER, \
+                PRIMARY KEY(ip, chunks, chunk))',
+            'INSERT INTO portchunk_layout SELECT ip, 0, chunk, checked \
+                FROM portchunk WHERE chunk=-1',
+            'DROP TABLE portchunk',
+            'ALTER TABLE portchunk_layout RENAME TO portchunk'],
+    ]
+
+    def migrate(self, conn):
+        '''
+        apply migrations not yet applied, each one in its own transaction
+        return: schema version
+
+        '''
+
+        cursor = conn.cursor()
+        conn.commit()
+        while True:
+            cursor.execute('BEGIN IMMEDIATE') #one migrator at a time
+            try:
+                version = cursor.execute('PRAGMA user_version').fetchone()[0]
+                if version >= len(self.MIGRATIONS):
+                    conn.rollback()
+                    return version
+                for sql in self.MIGRATIONS[version]:
+                    cursor.execute(sql)
+                cursor.execute('PRAGMA user_version=%d' %(version + 1))
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+
+##############################################################################
+
+
 class MyDB:
     '''
     handle my database
     
     '''
 
-    def __init__(self, database='hal9000.db'):
+    HOST_COLUMNS = ('ip', 'name', 'stat', 'osname', 'osvendor', 'osfamily',
+        'osgen', 'osaccuracy', 'dept', 'admin', 'timestamp', 'portchktime',
+        'desc')
+    SERVICE_COLUMNS = ('ip', 'portid', 'protocol', 'state', 'reason',
+        'servname', 'product', 'version', 'dept', 'admin', 'timestamp', 'desc')
+    HOST_KEYS = ('ip',)
+    SERVICE_KEYS = ('ip', 'portid', 'protocol')
+    TIME_COLUMNS = ('timestamp', 'portchktime') #move on every observation
+
+    def __init__(self, database='hal9000.db', owners=None):
+        '''
+        owners: Owners filling dept and admin of rows that have none, or None
+
+        '''
+
+        self.owners = owners
         try:
-            self.conn = sqlite3.connect(database)
+            self.conn = sqlite3.connect(database, timeout=30)
             self.cursor = self.conn.cursor()
+            self.cursor.execute('PRAGMA journal_mode=WAL') #readers never block
+            self.cursor.execute('PRAGMA synchronous=NORMAL')
+            Schema().migrate(self.conn)
         except:
             raise MyExcept('Error: Initiate database.')
 
@@ -96,11 +468,26 @@ class MyDB:
         '''
 
         try:
-            self.cursor.execute('SELECT * FROM host WHERE ip=(?)', (ip,))
-            return self.cursor.fetchone()
+            with metrics.timer('db_seconds', op='select_host'):
+                self.cursor.execute('SELECT * FROM host WHERE ip=(?)', (ip,))
+                return self.cursor.fetchone()
         except:
             raise MyExcept('Error: Get host record.')
 
+    def get_host_stat(self, ip):
+        '''
+        get stat of one host from db.host
+        return: 'up', 'down' or None if inexiste
+
+        '''
+
+        try:
+            self.cursor.execute('SELECT stat FROM host WHERE ip=(?)', (ip,))
+            rec = self.cursor.fetchone()
+            return None if rec is None else rec[0]
+        except:
+            raise MyExcept('Error: Get host stat.')
+
     def get_host_all_active(self):
         '''
         get all up hosts from db.host
@@ -109,7 +496,7 @@ class MyDB:
         '''
 
         try:
-            self.cursor.execute('SELECT ip FROM host WHERE stat="up"')
+            self.cursor.execute('SELECT ip FROM host WHERE stat=(?)', ('up',))
             return self.cursor.fetchall()
         except:
             raise MyExcept('Error: Get hosts all acitve ip.')
@@ -122,7 +509,7 @@ class MyDB:
         '''
 
         try:
-            self.cursor.execute('SELECT ip FROM host WHERE stat="up" ORDER BY timestamp LIMIT 1')
+            self.cursor.execute('SELECT ip FROM host WHERE stat=(?) ORDER BY timestamp LIMIT 1', ('up',))
             return self.cursor.fetchone()
         except:
             raise MyExcept('Error: get host oldest timestamp.')
@@ -148,7 +535,7 @@ class MyDB:
         '''
 
         try:
-            self.cursor.execute('SELECT ip FROM host WHERE stat="up" ORDER BY portchktime LIMIT 1')
+            self.cursor.execute('SELECT ip FROM host WHERE stat=(?) ORDER BY portchktime LIMIT 1', ('up',))
             return self.cursor.fetchone()
         except:
             raise MyExcept('Error: get host oldest portchktime.')
@@ -161,22 +548,23 @@ class MyDB:
         '''
 
         try:
-            self.cursor.execute(
-                'REPLACE INTO host VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)',(
-                    record.get('ip'),
-                    record.get('name'),
-                    record.get('stat'),
-                    record.get('osname'),
-                    record.get('osvendor'),
-                    record.get('osfamily'),
-                    record.get('osgen'),
-                    record.get('osaccuracy'),
-                    record.get('dept'),
-                    record.get('admin'),
-                    record.get('timestamp'),
-                    record.get('portchktime'),
-                    record.get('desc')))
-            self.conn.commit()
+            with metrics.timer('db_seconds', op='replace_host'):
+                self.cursor.execute(
+                    'REPLACE INTO host VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)',(
+                        record.get('ip'),
+                        record.get('name'),
+                        record.get('stat'),
+                        record.get('osname'),
+                        record.get('osvendor'),
+                        record.get('osfamily'),
+                        record.get('osgen'),
+                        record.get('osaccuracy'),
+                        record.get('dept'),
+                        record.get('admin'),
+                        record.get('timestamp'),
+                        record.get('portchktime'),
+                        record.get('desc')))
+                self.conn.commit()
         except:
             raise MyExcept('Error: Replace host record.')
 
@@ -188,9 +576,10 @@ class MyDB:
 
         if record is None or record.get('ip') is None:
             return
-
         rec = self._get_host_record(record.get('ip'))
         if rec is None: #ip record inexiste
+            record = self._fill(record)
+            self._log('host', None, record)
             self._replace_host_record(record)
         else:
             val = {'ip': record.get('ip'),
@@ -206,7 +595,11 @@ class MyDB:
                 'timestamp': rec[10] if record.get('timestamp') is None else record.get('timestamp'),
                 'portchktime': rec[11] if record.get('portchktime') is None else record.get('portchktime'),
                 'desc': rec[12] if record.get('desc') is None else record.get('desc')}
-            self._replace_host_record(val)
+            val = self._fill(val)
+            if self._log('host', rec, val):
+                self._replace_host_record(val)
+            else: #seen again, nothing changed
+                self._bump('host', rec, val)
 
     def _get_service_record(self, ip, portid, protocol):
         '''
@@ -216,9 +609,10 @@ class MyDB:
         '''
 
         try:
-            self.cursor.execute('SELECT * FROM service WHERE ip=(?) AND \
-                portid=(?) AND protocol=(?)', (ip,portid,protocol))
-            return self.cursor.fetchone()
+            with metrics.timer('db_seconds', op='select_service'):
+                self.cursor.execute('SELECT * FROM service WHERE ip=(?) AND \
+                    portid=(?) AND protocol=(?)', (ip,portid,protocol))
+                return self.cursor.fetchone()
         except:
             raise MyExcept('Error: Get service record.')
 
@@ -229,11 +623,110 @@ class MyDB:
         '''
 
         try:
-            self.cursor.execute('SELECT ip,portid,timestamp FROM service WHERE state="open" ORDER BY timestamp LIMIT 1')
+            self.cursor.execute('SELECT ip,portid,timestamp FROM service WHERE state=(?) ORDER BY timestamp LIMIT 1', ('open',))
             return self.cursor.fetchone()
         except:
             raise MyExcept('Error: get service oldest timestamp record.')
 
+    def get_backlog_age(self, now=None):
+        '''
+        how far behind the round-robin loops are
+        return: {'timestamp': s, 'portchktime': s, 'service': s} of the
+        oldest host timestamp, up host portchktime, open service timestamp
+
+        '''
+
+        if now is None:
+            now = int(time.time())
+        result = {}
+        try:
+            for name, sql, params in (
+                    ('timestamp', 'SELECT MIN(timestamp) FROM host', ()),
+                    ('portchktime', 'SELECT MIN(portchktime) FROM host \
+                        WHERE stat=(?)', ('up',)),
+                    ('service', 'SELECT MIN(timestamp) FROM service \
+                        WHERE state=(?)', ('open',))):
+                self.cursor.execute(sql, params)
+                oldest = self.cursor.fetchone()[0]
+                result[name] = None if oldest is None else now - oldest
+            return result
+        except:
+            raise MyExcept('Error: get backlog age.')
+
+    def get_service_tcp_open_ports(self, ip):
+        '''
+        get all open tcp ports of one host
+        return: set of portid
+
+        '''
+
+        try:
+            #+state keeps sqlite on the primary key of ip, off the state index
+            self.cursor.execute('SELECT portid FROM service WHERE ip=(?) \
+                AND protocol=(?) AND +state=(?)', (ip, 'tcp', 'open'))
+            return set([row[0] for row in self.cursor.fetchall()])
+        except:
+            raise MyExcept('Error: get service open ports.')
+
+    def get_port_chunks(self, ip, chunks):
+        '''
+        check times of the port chunks of one host in the layout of
+        chunks parts, see set_port_chunk
+        return: {chunk: checked}
+
+        '''
+
+        try:
+            self.cursor.execute('SELECT chunk, checked FROM portchunk \
+                WHERE ip=(?) AND chunks=(?) AND chunk>=0', (ip, chunks))
+            return dict(self.cursor.fetchall())
+        except:
+            raise MyExcept('Error: get port chunks.')
+
+    def set_port_chunk(self, ip, chunk, chunks, checked=None):
+        '''
+        record one checked chunk of 1-65535 cut in chunks, -1 for top ports
+        rows are kept per layout, chunk 0 of 4 is not chunk 0 of 16; once
+        all chunks of this layout were checked, portchktime of host is the
+        oldest of them: every port was checked since then
+
+        '''
+
+        if checked is None:
+            checked = int(time.time())
+        try:
+            self.cursor.execute('REPLACE INTO portchunk VALUES(?,?,?,?)',
+                (ip, 0 if chunk < 0 else chunks, chunk, checked))
+            if chunk >= 0:
+                self.cursor.execute('UPDATE host SET portchktime=(SELECT \
+                    MIN(checked) FROM portchunk WHERE ip=(?) AND \
+                    chunks=(?) AND chunk>=0 AND chunk<(?)) WHERE ip=(?) AND \
+                    (SELECT COUNT(*) FROM portchunk WHERE ip=(?) AND \
+                    chunks=(?) AND chunk>=0 AND chunk<(?))=(?)',
+                    (ip, chunks, chunks, ip, ip, chunks, chunks, chunks))
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise MyExcept('Error: set port chunk.')
+
+    def get_service_tcp_stale_ports(self, ip, before=None):
+        '''
+        get open tcp ports of one host whose timestamp is older than before
+        return: list of portid, oldest first
+
+        '''
+
+        if before is None:
+            before = int(time.time())
+        try:
+            #+state keeps sqlite on the primary key of ip, off the state index
+            self.cursor.execute('SELECT portid FROM service WHERE ip=(?) \
+                AND protocol=(?) AND +state=(?) AND IFNULL(timestamp, 0)<(?) \
+                ORDER BY timestamp', (ip, 'tcp', 'open', before))
+            return [row[0] for row in self.cursor.fetchall()]
+        except:
+            raise MyExcept('Error: get service stale ports.')
+
     def _replace_service_record(self, record):
         '''
         update all columns of service by (ip,portid,protocol) create if inexiste
@@ -242,21 +735,22 @@ class MyDB:
         '''
 
         try:
-            self.cursor.execute(
-                'REPLACE INTO service VALUES(?,?,?,?,?,?,?,?,?,?,?,?)',(
-                    record.get('ip'),
-                    record.get('portid'),
-                    record.get('protocol'),
-                    record.get('state'),
-                    record.get('reason'),
-                    record.get('servname'),
-                    record.get('product'),
-                    record.get('version'),
-                    record.get('dept'),
-                    record.get('admin'),
-                    record.get('timestamp'),
-                    record.get('desc')))
-            self.conn.commit()
+            with metrics.timer('db_seconds', op='replace_service'):
+                self.cursor.execute(
+                    'REPLACE INTO service VALUES(?,?,?,?,?,?,?,?,?,?,?,?)',(
+                        record.get('ip'),
+                        record.get('portid'),
+                        record.get('protocol'),
+                        record.get('state'),
+                        record.get('reason'),
+                        record.get('servname'),
+                        record.get('product'),
+                        record.get('version'),
+                        record.get('dept'),
+                        record.get('admin'),
+                        record.get('timestamp'),
+                        record.get('desc')))
+                self.conn.commit()
         except:
             raise MyExcept('Error: Replace service record.')
 
@@ -269,10 +763,11 @@ class MyDB:
         if record is None or record.get('ip') is None or \
         record.get('portid') is None or record.get('protocol') is None:
             return
-
         rec = self._get_service_record(
             record.get('ip'), record.get('portid'), record.get('protocol'))
         if rec is None: #(ip,portid,protocol) record inexiste
+            record = self._fill(record)
+            self._log('service', None, record)
             self._replace_service_record(record)
         else:
             val = {'ip': record.get('ip')}
@@ -287,263 +782,3445 @@ class MyDB:
             val['admin'] = rec[9] if record.get('admin') is None else record.get('admin')
             val['timestamp'] = rec[10] if record.get('timestamp') is None else record.get('timestamp')
             val['desc'] = rec[11] if record.get('desc') is None else record.get('desc')
-            self._replace_service_record(val)
+            val = self._fill(val)
+            if self._log('service', rec, val):
+                self._replace_service_record(val)
+            else: #seen again, nothing changed
+                self._bump('service', rec, val)
 
-##############################################################################
+    def _fill(self, record):
+        '''
+        dept and admin from owners where the merged record has none, so
+        owners never overwrite what was set by hand or imported
 
+        '''
 
-class SplitIpAddr:
-    '''
-    split network list to ip
-    input likes ['ipa/24', 'ipb/26', 'ipc']
-    return lieks ['ipa', 'ipb', 'ipc', 'ipd']
-    
-    '''
+        if self.owners is None:
+            return record
+        return self.owners.fill(record)
 
-    def split(self, netlist):
+    def _columns(self, table):
+        if table == 'host':
+            return self.HOST_COLUMNS, self.HOST_KEYS
+        return self.SERVICE_COLUMNS, self.SERVICE_KEYS
+
+    def _delta(self, table, old, new):
+        '''
+        columns of new, a merged record, that differ from old, a stored row
+        or None for a new one; time columns are left out
+        return: {column: [old, new]}, empty if nothing changed
+
+        '''
+
+        delta = {}
+        for i, col in enumerate(self._columns(table)[0]):
+            if col in self.TIME_COLUMNS:
+                continue
+            before = None if old is None else old[i]
+            if new.get(col) != before:
+                delta[col] = [before, new.get(col)]
+        return delta
+
+    def _log(self, table, old, new, now=None):
+        '''
+        add the delta of old to new to table_history, commit is the caller's
+        return: True if there was a change
+
+        '''
+
+        delta = self._delta(table, old, new)
+        if len(delta) == 0:
+            return False
+        keys = self._columns(table)[1]
         try:
-            hostlist = []
-            for net in netlist:
-                if '/' in str(net):
-                    hosts = list(ipaddress.ip_network(net).hosts())
-                    for host in hosts:
-                        hostlist.append(str(host))
-                else:
-                    hostlist.append(net)
-            return hostlist
+            self.cursor.execute('INSERT INTO %s_history VALUES(%s)' %(table,
+                ','.join(['?'] * (len(keys) + 2))),
+                tuple([new.get(key) for key in keys]) +
+                (now or int(time.time()), json.dumps(delta)))
         except:
-            raise MyExcept('Error: IP address.')
+            raise MyExcept('Error: Log %s change.' %(table))
+        metrics.inc('db_changes_total', table=table)
+        return True
 
-##############################################################################
+    def _bump(self, table, old, new):
+        '''
+        only move the time columns of an unchanged row, if they moved
 
+        '''
 
-class Ping:
-    '''
-    ping method
-    
-    '''
- 
-    def win_ping(self, ip):
+        columns, keys = self._columns(table)
+        times = [col for col in columns if col in self.TIME_COLUMNS]
+        if all([new.get(col) == old[columns.index(col)] for col in times]):
+            return
+        try:
+            self.cursor.execute('UPDATE %s SET %s WHERE %s' %(table,
+                ','.join(['%s=(?)' %(col) for col in times]),
+                ' AND '.join(['%s=(?)' %(key) for key in keys])),
+                tuple([new.get(col) for col in times]) +
+                tuple([new.get(key) for key in keys]))
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise MyExcept('Error: Bump %s record.' %(table))
+
+    def _get_rows(self, table, columns, keys, records):
         '''
-        windows ping
-        result is affected by denying of ping
-        return {ip:, stat:, timestamp:}
+        stored rows of records, fetched by ip in chunks of 500
+        return: {key tuple: row tuple}
 
-        -------------------------------
-        windows ping output likes this:
-        -------------------------------
+        '''
 
-        Pinging 10.4.100.177 with 32 bytes of data:
-        Reply from 10.4.100.177: bytes=32 time=2ms TTL=64
-        Reply from 10.4.100.177: bytes=32 time=1ms TTL=64
-        Reply from 10.4.100.177: bytes=32 time=3ms TTL=64
+        iplist = sorted(set([record.get('ip') for record in records]))
+        rows = {}
+        for i in range(0, len(iplist), 500):
+            chunk = iplist[i:i + 500]
+            self.cursor.execute('SELECT %s FROM %s WHERE ip IN (%s)' %(
+                ','.join(['"%s"' %(col) for col in columns]), table,
+                ','.join(['?'] * len(chunk))), chunk)
+            for row in self.cursor.fetchall():
+                rows[tuple([row[columns.index(key)] for key in keys])] = row
+        return rows
 
-        Ping statistics for 10.4.100.177:
-            Packets: Sent = 3, Received = 3, Lost = 0 (0% loss),
-        Approximate round trip times in milli-seconds:
-            Minimum = 1ms, Maximum = 3ms, Average = 2ms
+    def _bulk_upsert(self, table, columns, keys, records):
+        '''
+        insert or merge many records in one transaction
+        only not-none columns overwrite the stored row, like update_*_record
+        dept and admin still none after the merge are filled from owners
+        rows are only rewritten, and logged to table_history, if the merge
+        changed them; otherwise just their time columns are bumped
+        user ensures the correctness
 
         '''
 
+        if len(records) == 0:
+            return 0
+        times = [col for col in columns if col in self.TIME_COLUMNS]
+
+        now = int(time.time())
         try:
-            cmd = 'ping -n 3 -w 50 ' + ip
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            with metrics.timer('db_seconds', op='bulk_' + table):
+                stored = self._get_rows(table, columns, keys, records)
+                changed = collections.OrderedDict() #key: any delta so far
+                first = {} #stored row of key before this batch
+                logs = []
+                for record in records:
+                    key = tuple([record.get(col) for col in keys])
+                    old = stored.get(key)
+                    if key not in first:
+                        first[key] = old
+                        changed[key] = False
+                    merged = {} if old is None else dict(zip(columns, old))
+                    for col in columns:
+                        if record.get(col) is not None:
+                            merged[col] = record.get(col)
+                    merged = self._fill(merged)
+                    delta = self._delta(table, old, merged)
+                    if len(delta) > 0:
+                        changed[key] = True
+                        logs.append(key + (now, json.dumps(delta)))
+                    stored[key] = tuple([merged.get(col) for col in columns])
+
+                rows, bumps = [], [] #one write per key, the last one wins
+                for key, delta in changed.items():
+                    row = stored[key]
+                    if delta:
+                        rows.append(row)
+                    elif row != first[key]: #time columns only
+                        bumps.append(tuple([row[columns.index(col)]
+                            for col in times]) + key)
+                self.cursor.executemany('REPLACE INTO %s VALUES(%s)' %(
+                    table, ','.join(['?'] * len(columns))), rows)
+                self.cursor.executemany('INSERT INTO %s_history VALUES(%s)'
+                    %(table, ','.join(['?'] * (len(keys) + 2))), logs)
+                self.cursor.executemany('UPDATE %s SET %s WHERE %s' %(table,
+                    ','.join(['%s=(?)' %(col) for col in times]),
+                    ' AND '.join(['%s=(?)' %(key) for key in keys])), bumps)
+                self.conn.commit()
         except:
-            raise MyExcept('Error: ping or ip is not found.')
+            self.conn.rollback()
+            raise MyExcept('Error: Bulk update %s records.' %(table))
+        metrics.inc('db_rows_total', len(records), table=table)
+        metrics.inc('db_changes_total', len(rows), table=table)
+        return len(records)
 
-        print('Done with %s' %(ip))
-        return {'ip': ip,
-            'stat': 'up' if b'TTL' in proc.communicate()[0] else 'down',
-            'timestamp': int(time.time())}
+    def get_changes(self, since, until=None, table='service'):
+        '''
+        changes of table, 'host' or 'service', logged in [since, until)
+        return: list of {key columns, 'at': t, 'delta': {column: [old,
+        new]}}, oldest first; a new row has all its keys' old None
 
-##############################################################################
+        '''
 
+        keys = self._columns(table)[1]
+        try:
+            self.cursor.execute('SELECT %s, at, delta FROM %s_history \
+                WHERE at>=(?) AND at<(?) ORDER BY at, rowid' %(
+                ','.join(keys), table),
+                (since, 2 ** 62 if until is None else until))
+            return [dict(list(zip(keys, row)) + [('at', row[-2]),
+                ('delta', json.loads(row[-1]))])
+                for row in self.cursor.fetchall()]
+        except:
+            raise MyExcept('Error: Get %s changes.' %(table))
 
-class Scanner:
-    '''
-    various scan methods by nmap
-    
-    '''
+    def get_host_at(self, ip, at):
+        '''
+        host record of ip as it was at time at, None if not known then
+        time columns are not in the history, they are None
 
-    def __init__(self):
         '''
-        check if nmap existe
-        
+
+        records = self._rewind('host', ip, at)
+        return records[0] if len(records) > 0 else None
+
+    def get_services_at(self, ip, at):
+        '''
+        service records of ip as they were at time at
+        time columns are not in the history, they are None
+
+        '''
+
+        return self._rewind('service', ip, at)
+
+    def _rewind(self, table, ip, at):
         '''
+        stored rows of ip with the changes logged after at undone
 
+        '''
+
+        columns, keys = self._columns(table)
         try:
-            cmd = 'nmap -V'
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            self.cursor.execute('SELECT %s FROM %s WHERE ip=(?)' %(
+                ','.join(['"%s"' %(col) for col in columns]), table), (ip,))
+            records = {}
+            for row in self.cursor.fetchall():
+                record = dict(zip(columns, row))
+                records[tuple([record[key] for key in keys])] = record
+            self.cursor.execute('SELECT %s, delta FROM %s_history WHERE ip=(?) \
+                AND at>(?) ORDER BY at DESC, rowid DESC' %(','.join(keys),
+                table), (ip, at))
+            changes = self.cursor.fetchall()
         except:
-            raise MyExcept('Error: nmap was not found in path.')
+            raise MyExcept('Error: Get %s at %d.' %(table, at))
 
-        nmap_output = proc.communicate()[0] #sav stdout
-        if b'Nmap version' not in nmap_output:
-            raise MyExcept('Error: nmap was not found in path.')
+        for change in changes:
+            key = tuple(change[:-1])
+            delta = json.loads(change[-1])
+            if keys[0] in delta and delta[keys[0]][0] is None:
+                records.pop(key, None) #created after at
+                continue
+            record = records.get(key)
+            if record is None:
+                continue
+            for col, (before, after) in delta.items():
+                record[col] = before
+        for record in records.values():
+            for col in self.TIME_COLUMNS:
+                if col in record:
+                    record[col] = None
+        return sorted(records.values(), key=lambda record:
+            [record[key] for key in keys])
 
-    def scan_os(self, ip):
+    def bulk_update_hosts(self, records):
         '''
-        guess host's os info by nmap scan
-        return: dict record
-        
-        ---------------------------
-        nmap xml output likes this:
-        ---------------------------
+        update_host_record for many records with one commit
+        return: number of records written
+
+        '''
+
+        return self._bulk_upsert('host', self.HOST_COLUMNS, ('ip',),
+            [record for record in records
+                if record is not None and record.get('ip') is not None])
+
+    def bulk_update_services(self, records):
+        '''
+        update_service_record for many records with one commit
+        return: number of records written
+
+        '''
+
+        return self._bulk_upsert('service', self.SERVICE_COLUMNS,
+            ('ip', 'portid', 'protocol'),
+            [record for record in records if record is not None and
+                record.get('ip') is not None and
+                record.get('portid') is not None and
+                record.get('protocol') is not None])
+
+    def iter_rows(self, table, after=None, chunk=5000):
+        '''
+        all rows of table, 'host' or 'service', in key order, read by
+        chunks on the primary key so memory stays flat
+        after: key tuple to start behind, like ('10.0.0.1', 80, 'tcp')
+        return: iterator of records
+
+        '''
+
+        columns, keys = self._columns(table)
+        sql = 'SELECT %s FROM %s%%s ORDER BY %s LIMIT %d' %(
+            ','.join(['"%s"' %(col) for col in columns]), table,
+            ','.join(keys), chunk)
+        behind = ' WHERE (%s)>(%s)' %(','.join(keys),
+            ','.join(['?'] * len(keys)))
+        while True:
+            try:
+                if after is None:
+                    rows = self.cursor.execute(sql %('')).fetchall()
+                else:
+                    rows = self.cursor.execute(sql %(behind),
+                        tuple(after)).fetchall()
+            except:
+                raise MyExcept('Error: Read %s rows.' %(table))
+            for row in rows:
+                yield dict(zip(columns, row))
+            if len(rows) < chunk:
+                return
+            after = tuple([rows[-1][columns.index(key)] for key in keys])
+
+##############################################################################
+
+
+class JobQueue:
+    '''
+    persistent work queue in table job, shared by any number of workers
+    a job is (kind, target) likes ('ping', 'ip') or ('service', 'ip')
+
+    a job is claimable when due <= now. claiming sets due to the lease
+    expiry, so a job of a dead worker comes back by itself once its lease
+    expires. complete() and fail() only touch jobs still owned by caller.
+    the default owner is host, pid and thread, so driver threads sharing
+    a process never complete or extend each other's jobs
+
+    '''
+
+    SEED = {'ping': 'SELECT ip, IFNULL(timestamp, 0) FROM host',
+        'ports': 'SELECT ip, IFNULL(portchktime, 0) FROM host \
+            WHERE stat=\'up\'',
+        'topports': 'SELECT ip, IFNULL((SELECT checked FROM portchunk \
+            WHERE portchunk.ip=host.ip AND chunk=-1), 0) FROM host \
+            WHERE stat=\'up\'',
+        'service': 'SELECT ip, MIN(IFNULL(timestamp, 0)) FROM service \
+            WHERE state=\'open\' AND protocol=\'tcp\' GROUP BY ip'}
+
+    def __init__(self, mydb, owner=None, lease=900, backoff=60,
+            maxbackoff=86400):
+        self.mydb = mydb
+        self.owner = owner or '%s-%d-%d' %(socket.gethostname(),
+            os.getpid(), threading.get_ident())
+        self.lease = lease
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+
+    def enqueue(self, kind, targets, due=0):
+        '''
+        add jobs, existing ones are kept as they are
+        return: number of new jobs
 
-        <?xml version="1.0" encoding="UTF-8"?>
-        <!DOCTYPE nmaprun>
-        <?xml-stylesheet href="file:///C:/Program Files (x86)/Nmap/nmap.xsl" type="text/xsl"?>
-        <!-- Nmap 7.40 scan initiated Sun Feb 05 12:04:03 2017 as: nmap -oX - -O --osscan-limit 192.168.5.1 -->
-        <nmaprun scanner="nmap" args="nmap -oX - -O --osscan-limit 192.168.5.1" start="1486267443" startstr="Sun Feb 05 12:04:03 2017" version="7.40" xmloutputversion="1.04">
-            <scaninfo type="syn" protocol="tcp" numservices="1000" services="1,3-4,6-7,9,13,17,19-26,30,32-33,37,42-43,49,53,70,79-85,88-90,99-100,106,109-111,113,119,125,135,139,143-144,146,161,163,179,199,211-212,222,254-256,259,264,280,301,306,311,340,366,389,406-407,416-417,425,427,443-445,458,464-465,481,497,500,512-515,524,541,543-545,548,554-555,563,587,593,616-617,625,631,636,646,648,666-668,683,687,691,700,705,711,714,720,722,726,749,765,777,783,787,800-801,808,843,873,880,888,898,900-903,911-912,981,987,990,992-993,995,999-1002,1007,1009-1011,1021-1100,1102,1104-1108,1110-1114,1117,1119,1121-1124,1126,1130-1132,1137-1138,1141,1145,1147-1149,1151-1152,1154,1163-1166,1169,1174-1175,1183,1185-1187,1192,1198-1199,1201,1213,1216-1218,1233-1234,1236,1244,1247-1248,1259,1271-1272,1277,1287,1296,1300-1301,1309-1311,1322,1328,1334,1352,1417,1433-1434,1443,1455,1461,1494,1500-1501,1503,1521,1524,1533,1556,1580,1583,1594,1600,1641,1658,1666,1687-1688,1700,1717-1721,1723,1755,1761,1782-1783,1801,1805,1812,1839-1840,1862-1864,1875,1900,1914,1935,1947,1971-1972,1974,1984,1998-2010,2013,2020-2022,2030,2033-2035,2038,2040-2043,2045-2049,2065,2068,2099-2100,2103,2105-2107,2111,2119,2121,2126,2135,2144,2160-2161,2170,2179,2190-2191,2196,2200,2222,2251,2260,2288,2301,2323,2366,2381-2383,2393-2394,2399,2401,2492,2500,2522,2525,2557,2601-2602,2604-2605,2607-2608,2638,2701-2702,2710,2717-2718,2725,2800,2809,2811,2869,2875,2909-2910,2920,2967-2968,2998,3000-3001,3003,3005-3007,3011,3013,3017,3030-3031,3052,3071,3077,31278,63331,64623,64680,65000,65129,65389"/>
-            <verbose level="0"/>
-            <debugging level="0"/>
-            <host starttime="1486267444" endtime="1486267451">
-                <status state="up" reason="arp-response" reason_ttl="0"/>
-                <address addr="192.168.5.1" addrtype="ipv4"/>
-                <address addr="78:C1:A7:0B:43:32" addrtype="mac" vendor="zte"/>
-                <hostnames></hostnames>
-                <ports>
-                    <extraports state="closed" count="996"><extrareasons reason="resets" count="996"/></extraports>
-                    <port protocol="tcp" portid="53"><state state="open" reason="syn-ack" reason_ttl="64"/><service name="domain" method="table" conf="3"/></port>
-                    <port protocol="tcp" portid="80"><state state="open" reason="syn-ack" reason_ttl="64"/><service name="http" method="table" conf="3"/></port>
-                    <port protocol="tcp" portid="7777"><state state="open" reason="syn-ack" reason_ttl="64"/><service name="cbt" method="table" conf="3"/></port>
-                    <port protocol="tcp" portid="52869"><state state="open" reason="syn-ack" reason_ttl="64"/><service name="unknown" method="table" conf="3"/></port>
-                </ports>
-                <os>
-                    <portused state="open" proto="tcp" portid="53"/>
-                    <portused state="closed" proto="tcp" portid="1"/>
-                    <portused state="closed" proto="udp" portid="35682"/>
-                    <osmatch name="Linux 2.6.32 - 3.10" accuracy="100" line="53646">
-                        <osclass type="general purpose" vendor="Linux" osfamily="Linux" osgen="2.6.X" accuracy="100"><cpe>cpe:/o:linux:linux_kernel:2.6</cpe></osclass>
-                        <osclass type="general purpose" vendor="Linux" osfamily="Linux" osgen="3.X" accuracy="100"><cpe>cpe:/o:linux:linux_kernel:3</cpe></osclass>
-                    </osmatch>
-                </os>
-                <uptime seconds="1179974" lastboot="Sun Jan 22 20:17:57 2017"/>
-                <distance value="1"/>
-                <tcpsequence index="258" difficulty="Good luck!" values="A0D96948,F32FE618,9944DBDB,C0BE68C8,15CA9851,3FCCDE8"/>
-                <ipidsequence class="All zeros" values="0,0,0,0,0,0"/>
-                <tcptssequence class="100HZ" values="7087F02,7087F0D,7087F18,7087F23,7087F2E,7087F39"/>
-                <times srtt="15960" rttvar="28032" to="128088"/>
-            </host>
-            <runstats>
-                <finished time="1486267451" timestr="Sun Feb 05 12:04:11 2017" elapsed="8.36" summary="Nmap done at Sun Feb 05 12:04:11 2017; 1 IP address (1 host up) scanned in 8.36 seconds" exit="success"/>
-                <hosts up="1" down="0" total="1"/>
-            </runstats>
-        </nmaprun>
-        
         '''
 
         try:
-            cmd = 'nmap -oX - -Pn -O --osscan-limit --host-timeout 360 ' + ip
-            proc = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            before = self.mydb.conn.total_changes
+            self.mydb.cursor.executemany(
+                'INSERT OR IGNORE INTO job(kind, target, due) VALUES(?,?,?)',
+                [(kind, str(target), due) for target in targets])
+            self.mydb.conn.commit()
+            return self.mydb.conn.total_changes - before
         except:
-            raise MyExcept('Error: nmap os scan.')
-        
-        nmap_output = bytes.decode(proc.communicate()[0]) #sav stdout
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Enqueue %s jobs.' %(kind))
+
+    def seed(self, kind):
+        '''
+        add jobs of kind for rows of host or service, oldest first
+        return: number of new jobs
+
+        '''
+
         try:
-            dom = ET.fromstring(nmap_output) #None will also raise MyExcept
+            before = self.mydb.conn.total_changes
+            self.mydb.cursor.execute(
+                'INSERT OR IGNORE INTO job(kind, target, due) SELECT ?, * \
+                FROM (' + self.SEED[kind] + ')', (kind,))
+            self.mydb.conn.commit()
+            return self.mydb.conn.total_changes - before
         except:
-            raise MyExcept('Error: nmap output.')
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Seed %s jobs.' %(kind))
 
-        if dom.find('host') is None:
-            return None
-        if dom.find('host/os/osmatch') is None:
-            return None
-        record = {'ip': ip,
-            'osname': dom.find('host/os/osmatch').get('name')}
-        osclass = dom.find('host/os/osmatch/osclass')
-        if osclass is not None:
-            record['osvendor'] = osclass.get('vendor')
-            record['osfamily'] = osclass.get('osfamily')
-            record['osgen'] = osclass.get('osgen')
-            record['osaccuracy'] = int(osclass.get('accuracy'))
-        print('Done with %s' %(ip))
-        return record
+    def expedite(self, kind, targets):
+        '''
+        make jobs due now, adding them if needed, leased ones are left alone
 
-    def scan_ports_tcp(self, ip):
         '''
-        only detects port's state, not service's version.
-        return only open or open|filtered ports
-        
+
+        if type(targets) is str:
+            targets = [targets]
+        self.enqueue(kind, targets)
+        try:
+            self.mydb.cursor.executemany('UPDATE job SET due=MIN(due, ?) \
+                WHERE kind=(?) AND target=(?) AND owner IS NULL',
+                [(int(time.time()), kind, target) for target in targets])
+            self.mydb.conn.commit()
+        except:
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Expedite %s jobs.' %(kind))
+
+    def claim(self, kind, count=1):
         '''
-        
+        atomically lease up to count due jobs, oldest first
+        return: list of target
+
+        '''
+
+        now = int(time.time())
+        if metrics.enabled:
+            self._observe(kind, now)
         try:
-            cmd = 'nmap -oX - -Pn -p 1-65535 -sS -T4 --host-timeout 360 ' + ip
-            proc = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.mydb.conn.commit()
+            metrics.inc('queue_claims_total', kind=kind)
+            self.mydb.cursor.execute('BEGIN IMMEDIATE') #one claimer at a time
+            self.mydb.cursor.execute('SELECT target FROM job WHERE kind=(?) \
+                AND due<=(?) ORDER BY due LIMIT (?)', (kind, now, count))
+            targets = [row[0] for row in self.mydb.cursor.fetchall()]
+            self.mydb.cursor.executemany('UPDATE job SET due=(?), owner=(?) \
+                WHERE kind=(?) AND target=(?)',
+                [(now + self.lease, self.owner, kind, target)
+                    for target in targets])
+            self.mydb.conn.commit()
+            return targets
         except:
-            raise MyExcept('Error: tcp ports fast scan error.')
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Claim %s jobs.' %(kind))
+
+    def _observe(self, kind, now):
+        '''
+        queue depth and backlog age gauges, at most every 10s
+
+        '''
+
+        if now - getattr(self, 'observed', 0) < 10:
+            return
+        self.observed = now
+        self.mydb.cursor.execute('SELECT COUNT(*), MIN(due) FROM job \
+            WHERE kind=(?) AND due<=(?)', (kind, now))
+        depth, oldest = self.mydb.cursor.fetchone()
+        metrics.set('queue_depth', depth, kind=kind)
+        metrics.set('queue_oldest_due_seconds',
+            0 if oldest is None else now - oldest, kind=kind)
+        for name, age in self.mydb.get_backlog_age(now).items():
+            if age is not None:
+                metrics.set('backlog_age_seconds', age, column=name)
+
+    def heartbeat(self, kind, targets):
+        '''
+        extend the lease of jobs still owned
+
+        '''
+
+        self._release(kind, targets, 'due=(?)',
+            (int(time.time()) + self.lease,))
+
+    def keepalive(self, kind, targets):
+        '''
+        heartbeat jobs every lease/3 seconds while a with block runs, for
+        probes that may outlast the lease, like a long nmap run
+            with queue.keepalive('service', jobs):
+                scanner.scan_services_tcp(targets)
+
+        '''
+
+        return _Keepalive(self, kind, targets)
+
+    def complete(self, kind, targets, due=None):
+        '''
+        finish owned jobs and schedule them again at due, default now
+
+        '''
+
+        if due is None:
+            due = int(time.time())
+        self._release(kind, targets,
+            'due=(?), owner=NULL, attempts=0, error=NULL', (int(due),))
+
+    def fail(self, kind, targets, error=None):
+        '''
+        give owned jobs back for a retry with exponential backoff
 
-        nmap_output = bytes.decode(proc.communicate()[0]) #sav stdout
+        '''
+
+        self._release(kind, targets,
+            'due=(?) + MIN((?) << MIN(attempts, 30), (?)), owner=NULL, \
+            attempts=attempts+1, error=(?)',
+            (int(time.time()), self.backoff, self.maxbackoff, error))
+
+    def _release(self, kind, targets, assign, params):
+        if type(targets) is str:
+            targets = [targets]
         try:
-            dom = ET.fromstring(nmap_output) #None will also raise MyExcept
+            self.mydb.cursor.executemany('UPDATE job SET ' + assign + \
+                ' WHERE kind=(?) AND target=(?) AND owner=(?)',
+                [params + (kind, target, self.owner) for target in targets])
+            self.mydb.conn.commit()
         except:
-            raise MyExcept('Error: nmap output.')
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Update %s jobs.' %(kind))
 
-        if dom.find('host') is None: #host is down
-            return None
 
-        result = [] #all ports' information
-        for port in dom.findall('host/ports/port'):
-            dport = {'ip': ip,
-                'portid': int(port.get('portid')),
-                'protocol': 'tcp',
-                'state': port.find('state').get('state'),
-                #'reason': port.find('state').get('reason'),
-                #'timestamp': int(dom.find('runstats/finished').get('time'))
-            }
-            if 'open' not in dport['state']:
-                continue
-            #if port.find('service') is not None:
-                #dport['servname'] = port.find('service').get('name')
-            result.append(dport)
 
-        if len(result) == 0:
-            return None
-        else:
-            return result
+class _Keepalive:
+    def __init__(self, queue, kind, targets):
+        self.queue = queue
+        self.kind = kind
+        self.targets = list(targets) if type(targets) is not str \
+            else [targets]
+        self.path = queue.mydb.conn.execute(
+            'PRAGMA database_list').fetchone()[2]
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._beat)
+        self.thread.daemon = True
 
-    def scan_service_tcp(self, ip, port):
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+    def _beat(self):
         '''
-        guess one service info by one given ip & one given TCP port
+        runs on its own connection, sqlite ones stay in their thread
+
+        '''
+
+        queue = JobQueue(MyDB(self.path), self.queue.owner, self.queue.lease)
+        try:
+            while not self.stop.wait(self.queue.lease / 3.0):
+                queue.heartbeat(self.kind, self.targets)
+        finally:
+            queue.mydb.conn.close()
+
+##############################################################################
+
+
+class Scheduler:
+    '''
+    change-aware rescan scheduler for one kind of JobQueue job
+    every observation says whether the target changed since last time;
+    a stable target grows its interval up to maxinterval, slower while its
+    rate (moving average of changes) is high; a changed or new one goes
+    back to mininterval.
+    budget caps probes per hour, pace() waits for the next free slot.
+
+    '''
+
+    def __init__(self, mydb, kind, mininterval=600, maxinterval=7*86400,
+            budget=None, growth=2.0, alpha=0.3):
+        self.mydb = mydb
+        self.kind = kind
+        self.mininterval = mininterval
+        self.maxinterval = maxinterval
+        self.budget = budget
+        self.growth = growth
+        self.alpha = alpha
+        self.slot = time.time()
+
+    def observe(self, target, changed, now=None):
+        '''
+        record one observation of target
+        return: next due time
 
         '''
 
+        if now is None:
+            now = int(time.time())
         try:
-            cmd = 'nmap -oX - -Pn -p ' + str(port) + ' -T4 -sV --version-light --host-timeout 20 ' + ip
-            proc = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.mydb.cursor.execute('SELECT interval, rate, seen, changed, \
+                lastchange FROM volatility WHERE kind=(?) AND target=(?)',
+                (self.kind, target))
+            rec = self.mydb.cursor.fetchone()
         except:
-            raise MyExcept('Error: nmap port scan.')
+            raise MyExcept('Error: Get volatility.')
+
+        if rec is None: #new target, look again soon
+            interval, rate, seen, count, lastchange = \
+                self.mininterval, 1.0, 0, 0, now
+        else:
+            interval, rate, seen, count, lastchange = rec
+        rate = self.alpha * (1.0 if changed else 0.0) + (1 - self.alpha) * rate
+        if changed:
+            interval = self.mininterval
+            count += 1
+            lastchange = now
+        elif rec is not None: #volatile targets back off slower
+            interval = min(self.maxinterval,
+                int(interval * (1 + (self.growth - 1) * (1 - rate))))
 
-        nmap_output = bytes.decode(proc.communicate()[0]) #sav stdout
         try:
-            dom = ET.fromstring(nmap_output) #None will also raise MyExcept
+            self.mydb.cursor.execute(
+                'REPLACE INTO volatility VALUES(?,?,?,?,?,?,?)',
+                (self.kind, target, interval, rate, seen + 1, count,
+                    lastchange))
+            self.mydb.conn.commit()
         except:
-            raise MyExcept('Error: nmap output.')
+            raise MyExcept('Error: Replace volatility.')
+        return now + interval
+
+    def pace(self):
+        '''
+        wait until the probe budget allows one more probe
+        return: seconds waited
+
+        '''
+
+        if self.budget is None:
+            return 0
+        now = time.time()
+        self.slot = max(self.slot, now)
+        wait = self.slot - now
+        self.slot += 3600.0 / self.budget
+        time.sleep(wait)
+        return wait
+
+##############################################################################
+
+
+class BatchWriter:
+    '''
+    collect records and write them by micro-batches
+    flush when size records are pending or interval seconds have passed
+    write likes MyDB().bulk_update_hosts
+    time is checked on add(), writes stay in the caller's thread; while
+    waiting for slow results poll with add(None), or iterate follow()
+
+    '''
+
+    def __init__(self, write, size=200, interval=5):
+        self.write = write
+        self.size = size
+        self.interval = interval
+        self.pending = []
+        self.flushtime = time.time()
+
+    def add(self, record):
+        '''
+        add one record, a list of records is added one by one
+
+        '''
+
+        if record is None:
+            pass
+        elif type(record) is list:
+            self.pending.extend(record)
+        else:
+            self.pending.append(record)
+
+        if len(self.pending) >= self.size or \
+        time.time() - self.flushtime >= self.interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        write all pending records
+        return: number of records written
+
+        '''
+
+        count = 0
+        if len(self.pending) > 0:
+            count = self.write(self.pending)
+            self.pending = []
+        self.flushtime = time.time()
+        return count
+
+    def follow(self, results):
+        '''
+        yield from results, a Pool imap iterator, flushing by interval
+        while the next result is slow to come; imap with chunksize over 1
+        gives a plain generator, checked by interval once per item
+
+        '''
+
+        if not hasattr(results, 'next'):
+            for result in results:
+                self.add(None)
+                yield result
+            return
+        while True:
+            try:
+                yield results.next(self.interval)
+            except StopIteration:
+                return
+            except multiprocessing.TimeoutError:
+                self.add(None)
+
+##############################################################################
+
+
+class Dump:
+    '''
+    stream the host or service table to and from csv or json lines files
+    format goes by extension: .csv, anything else is json lines
+    csv has a header of column names; imports take any subset of
+    MyDB columns, for instance ip,dept,admin,desc of a cmdb dump
+    imports merge by chunks, one transaction each, through
+    MyDB.bulk_update_*, so only not-none values overwrite stored ones
+    exports read by key order and resume behind the last complete
+    record of an unfinished file
+
+    '''
+
+    INTEGER_COLUMNS = ('portid', 'osaccuracy', 'timestamp', 'portchktime')
+
+    def __init__(self, mydb, table='host', chunk=5000):
+        self.mydb = mydb
+        self.table = table
+        self.chunk = chunk
+        self.columns, self.keys = mydb._columns(table)
+        self.write = mydb.bulk_update_hosts if table == 'host' \
+            else mydb.bulk_update_services
+
+    def _iscsv(self, filename):
+        return filename.lower().endswith('.csv')
+
+    def _record(self, record):
+        '''
+        typed record of a csv or json line, '' is None
+
+        '''
+
+        for col in self.INTEGER_COLUMNS:
+            value = record.get(col)
+            if value == '':
+                record[col] = None
+            elif value is not None:
+                record[col] = int(value)
+        for col, value in record.items():
+            if value == '':
+                record[col] = None
+        return record
+
+    def read(self, filename):
+        '''
+        records of a csv or json lines file, one at a time
+
+        '''
+
+        try:
+            fp = open(filename, newline='', encoding='utf-8')
+        except:
+            raise MyExcept('Error: Open %s.' %(filename))
+        with fp:
+            if self._iscsv(filename):
+                lines = csv.DictReader(fp)
+                self._known(lines.fieldnames or [], filename)
+                for record in lines:
+                    try:
+                        record = self._record(record)
+                    except (ValueError, TypeError, AttributeError):
+                        raise MyExcept('Error: %s line %d.' %(filename,
+                            lines.line_num))
+                    yield record
+                return
+            for number, line in enumerate(fp, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    self._known(record, filename, number)
+                    record = self._record(record)
+                except (ValueError, TypeError, AttributeError):
+                    raise MyExcept('Error: %s line %d.' %(filename, number))
+                yield record
+
+    def _known(self, columns, filename, number=None):
+        '''
+        refuse columns that are not in the table, csv and json alike
+
+        '''
+
+        unknown = set(columns) - set(self.columns)
+        if len(unknown) > 0:
+            raise MyExcept('Error: Unknown %s columns %s in %s%s.' %(
+                self.table, ','.join(sorted(unknown)), filename,
+                '' if number is None else ' line %d' %(number)))
+
+    def load(self, filename):
+        '''
+        import filename into the table
+        return: number of records merged
+
+        '''
+
+        count = 0
+        batch = []
+        for record in self.read(filename):
+            batch.append(record)
+            if len(batch) >= self.chunk:
+                count += self.write(batch)
+                batch = []
+        if len(batch) > 0:
+            count += self.write(batch)
+        return count
+
+    def _resume(self, filename):
+        '''
+        cut an unfinished export back to its last complete record
+        return: key tuple of that record, None for a new or empty file
+
+        '''
 
-        if dom.find('host') is None: #host is down
+        if not os.path.exists(filename):
             return None
+        if self._iscsv(filename):
+            cut, last = self._last_csv(filename)
+        else:
+            cut, last = self._last_json(filename)
+        with open(filename, 'rb+') as fp:
+            fp.truncate(cut)
+        if last is None:
+            return None
+        try:
+            record = self._record(last)
+            return tuple([record[key] for key in self.keys])
+        except (ValueError, TypeError, KeyError):
+            raise MyExcept('Error: %s does not end with a %s record.' %(
+                filename, self.table))
 
-        result = {'ip': ip,
-            'portid': port,
-            'protocol': 'tcp',
-            'timestamp': int(dom.find('runstats/finished').get('time'))}
+    def _last_csv(self, filename):
+        '''
+        csv fields may hold newlines, so records are found by csv.reader
+        over the whole file; one is complete if it ended on a newline
+        before the file ended, a quote cut open by a crash is not
+        return: (bytes up to the last complete record, that record)
 
-        portid = dom.find('host/ports/port')
-        if portid is None:
-            return result
+        '''
 
-        result['state'] = portid.find('state').get('state')
-        result['reason'] = portid.find('state').get('reason')
+        state = {'read': 0, 'eof': False, 'newline': True}
 
-        if portid.find('service') is not None:
-            result['servname'] = portid.find('service').get('name')
-            result['product'] = portid.find('service').get('product')
-            result['version'] = portid.find('service').get('version')
+        def lines(fp):
+            for line in fp:
+                state['read'] += len(line)
+                state['newline'] = line.endswith(b'\n')
+                yield line.decode('utf-8', errors='replace')
+            state['eof'] = True
 
-        return result
+        cut, last, header = 0, None, True
+        with open(filename, 'rb') as fp:
+            for row in csv.reader(lines(fp)):
+                if state['eof'] or not state['newline']:
+                    break
+                cut = state['read']
+                if header: #column names
+                    header = False
+                else:
+                    last = row
+        return cut, None if last is None else dict(zip(self.columns, last))
+
+    def _last_json(self, filename):
+        '''
+        json lines hold no raw newline, the tail of the file is enough
+        return: (bytes up to the last complete line, its record)
+
+        '''
+
+        with open(filename, 'rb') as fp:
+            fp.seek(0, os.SEEK_END)
+            start = max(0, fp.tell() - 65536)
+            fp.seek(start)
+            tail = fp.read()
+        cut = tail.rfind(b'\n') + 1
+        lines = tail[:cut].splitlines()
+        if len(lines) == 0:
+            return start + cut, None
+        try:
+            return start + cut, json.loads(lines[-1].decode('utf-8'))
+        except ValueError:
+            raise MyExcept('Error: %s does not end with a %s record.' %(
+                filename, self.table))
+
+    def dump(self, filename, resume=True):
+        '''
+        export the table to filename
+        resume: go on behind the last record of an existing file, else
+        start it over
+        return: number of records written by this call
+
+        '''
+
+        after = self._resume(filename) if resume else None
+        iscsv = self._iscsv(filename)
+        fresh = not resume or not os.path.exists(filename) or \
+            os.path.getsize(filename) == 0
+        count = 0
+        with open(filename, 'w' if fresh else 'a', newline='',
+                encoding='utf-8') as fp:
+            if iscsv:
+                lines = csv.writer(fp, lineterminator='\n')
+                if fresh:
+                    lines.writerow(self.columns)
+            for record in self.mydb.iter_rows(self.table, after, self.chunk):
+                if iscsv:
+                    lines.writerow([record[col] for col in self.columns])
+                else:
+                    fp.write(json.dumps(record) + '\n')
+                count += 1
+        return count
+
+##############################################################################
+
+
+class SplitIpAddr:
+    '''
+    split network list to ip
+    input likes ['ipa/24', 'ipb/26', 'ipc']
+    return lieks ['ipa', 'ipb', 'ipc', 'ipd']
+    
+    '''
+
+    def split(self, netlist):
+        try:
+            hostlist = []
+            for net in netlist:
+                if '/' in str(net):
+                    hosts = list(ipaddress.ip_network(net).hosts())
+                    for host in hosts:
+                        hostlist.append(str(host))
+                else:
+                    hostlist.append(net)
+            return hostlist
+        except:
+            raise MyExcept('Error: IP address.')
+
+##############################################################################
+
+
+class Targets:
+    '''
+    lazy target engine over ipv4 networks
+    input likes ['ipa/24', 'ipb', 'ipc-ipd', 'ipe-200'], exclude likewise
+    overlapping and adjacent entries are merged, excluded ones cut out,
+    only sorted (first, last) int ranges are kept in memory
+    iterating yields ip as str in ascending order, see also ints()
+
+    '''
+
+    def __init__(self, netlist, exclude=()):
+        self.ranges = self._subtract(
+            self._merge(self._parse(netlist)),
+            self._merge(self._parse(exclude)))
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        for i in self.ints():
+            yield '%d.%d.%d.%d' %(i >> 24, i >> 16 & 255, i >> 8 & 255, i & 255)
+
+    def __contains__(self, ip):
+        i = int(ipaddress.IPv4Address(ip))
+        pos = bisect.bisect_right(self.ranges, (i, 0xFFFFFFFF)) - 1
+        return pos >= 0 and self.ranges[pos][1] >= i
+
+    def count(self):
+        '''
+        number of targets, nothing is expanded
+
+        '''
+
+        return sum([last - first + 1 for first, last in self.ranges])
+
+    def ints(self):
+        '''
+        yield ip as int in ascending order
+
+        '''
+
+        for first, last in self.ranges:
+            for i in range(first, last + 1):
+                yield i
+
+    def batches(self, size):
+        '''
+        yield lists of at most size ip str, for bounded work submission
+
+        '''
+
+        batch = []
+        for ip in self:
+            batch.append(ip)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def _parse(self, netlist):
+        '''
+        entries to (first, last) int ranges
+        a network gives its hosts() like SplitIpAddr does
+
+        '''
+
+        ranges = []
+        try:
+            for net in netlist:
+                net = str(net).strip()
+                if net == '' or net.startswith('#'):
+                    continue
+                if '/' in net:
+                    network = ipaddress.IPv4Network(net, strict=False)
+                    first = int(network.network_address)
+                    last = int(network.broadcast_address)
+                    if network.num_addresses > 2: #no network, broadcast
+                        first, last = first + 1, last - 1
+                elif '-' in net:
+                    start, end = net.split('-', 1)
+                    first = int(ipaddress.IPv4Address(start))
+                    if '.' in end:
+                        last = int(ipaddress.IPv4Address(end))
+                    else: #last octet only
+                        last = (first & 0xFFFFFF00) + int(end)
+                else:
+                    first = last = int(ipaddress.IPv4Address(net))
+                if first > last:
+                    raise ValueError(net)
+                ranges.append((first, last))
+        except:
+            raise MyExcept('Error: IP address.')
+        return ranges
+
+    def _merge(self, ranges):
+        '''
+        sort ranges and join overlapping or adjacent ones
+
+        '''
+
+        merged = []
+        for first, last in sorted(ranges):
+            if len(merged) > 0 and first <= merged[-1][1] + 1:
+                if last > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], last)
+            else:
+                merged.append((first, last))
+        return merged
+
+    def _subtract(self, ranges, exclude):
+        '''
+        cut sorted exclude ranges out of sorted ranges
+
+        '''
+
+        result = []
+        for first, last in ranges:
+            for xfirst, xlast in exclude:
+                if xlast < first or xfirst > last:
+                    continue
+                if xfirst > first:
+                    result.append((first, xfirst - 1))
+                first = xlast + 1
+                if first > last:
+                    break
+            if first <= last:
+                result.append((first, last))
+        return result
+
+##############################################################################
+
+
+class Owners:
+    '''
+    owner (dept, admin, priority) of any ip by longest-prefix match over
+    the networks of Asset().owners(); a smaller network or range wins,
+    a later line on a tie. the nested networks are flattened once into
+    sorted disjoint intervals, so a lookup is one bisect
+
+    '''
+
+    def __init__(self, entries=()):
+        '''
+        entries: (network, dept, admin, priority) like Asset().owners()
+
+        '''
+
+        spans = []
+        for order, (net, dept, admin, priority) in enumerate(entries):
+            try:
+                if '/' in net: #whole network, unlike Targets
+                    network = ipaddress.IPv4Network(net, strict=False)
+                    ranges = [(int(network.network_address),
+                        int(network.broadcast_address))]
+                else:
+                    ranges = Targets([net]).ranges
+            except ValueError:
+                raise MyExcept('Error: IP address %s.' %(net))
+            for first, last in ranges:
+                spans.append((first, last, order, (dept, admin, priority)))
+
+        self.intervals = [] #(first, last, owner)
+        points = sorted(set([span[0] for span in spans] +
+            [span[1] + 1 for span in spans]))
+        spans.sort()
+        active = [] #heap of (size, -order, last, owner)
+        j = 0
+        for point, end in zip(points, points[1:]):
+            while j < len(spans) and spans[j][0] <= point:
+                first, last, order, owner = spans[j]
+                heapq.heappush(active, (last - first, -order, last, owner))
+                j += 1
+            while len(active) > 0 and active[0][2] < point:
+                heapq.heappop(active)
+            if len(active) == 0:
+                continue
+            owner = active[0][3]
+            if len(self.intervals) > 0 and self.intervals[-1][2] == owner \
+                    and self.intervals[-1][1] == point - 1:
+                self.intervals[-1] = (self.intervals[-1][0], end - 1, owner)
+            else:
+                self.intervals.append((point, end - 1, owner))
+        self.starts = [interval[0] for interval in self.intervals]
+
+    def __len__(self):
+        return len(self.intervals)
+
+    @staticmethod
+    def load(filename='asset.lst'):
+        return Owners(Asset().owners(filename))
+
+    def lookup(self, ip):
+        '''
+        return: (dept, admin, priority) of ip, str or int, None if unowned
+
+        '''
+
+        if type(ip) is not int:
+            try:
+                ip = struct.unpack('!I', socket.inet_aton(ip))[0]
+            except OSError:
+                return None
+        i = bisect.bisect_right(self.starts, ip) - 1
+        if i < 0 or ip > self.intervals[i][1]:
+            return None
+        return self.intervals[i][2]
+
+    def fill(self, record):
+        '''
+        record with dept and admin of its ip where they are None
+        return: a copy if anything was filled, else record itself
+
+        '''
+
+        if record.get('dept') is not None and record.get('admin') is not None:
+            return record
+        owner = self.lookup(record['ip'])
+        if owner is None:
+            return record
+        record = dict(record)
+        if record.get('dept') is None:
+            record['dept'] = owner[0]
+        if record.get('admin') is None:
+            record['admin'] = owner[1]
+        return record
+
+##############################################################################
+
+
+class HostState:
+    '''
+    compact state of every ip of Targets ranges, indexed by ipv4 int
+    up and open (any open tcp port) are bitsets, one bit per ip, seen is
+    the last up time as packed uint32; each range starts at a position
+    congruent to its first ip mod 256, so every /24 (up to /29) is whole
+    bytes and counts per subnet are slices
+    set operations go through python ints, whole bitsets at C speed:
+        now.ips(now.bits('up') & ~lastweek.bits('up'))
+    'up now, not last week' is a diff against last week's saved state;
+    seen is for looking up single ips, not for scanning
+    saved to one file, load() maps it back without parsing
+
+    '''
+
+    MAGIC = b'HAL9K\x00\x00\x01'
+    HEADER = struct.Struct('=8sII') #magic, number of ranges, positions
+    RANGE = struct.Struct('=III') #first, last, position of first
+
+    def __init__(self, ranges):
+        '''
+        ranges: Targets().ranges, sorted (first, last) ipv4 ints
+
+        '''
+
+        self.ranges = [(int(first), int(last)) for first, last in ranges]
+        self.starts = [first for first, last in self.ranges]
+        self.positions = []
+        size = 0
+        for first, last in self.ranges:
+            size += (first - size) % 256
+            self.positions.append(size)
+            size += last - first + 1
+        self.size = size + (-size) % 8
+        self.up = bytearray(self.size // 8)
+        self.open = bytearray(self.size // 8)
+        self.seen = array.array('I', bytes(4 * self.size))
+        self.mm = None
+
+    def index(self, ip):
+        '''
+        position of ip, str or int, None if it is out of the ranges
+
+        '''
+
+        if type(ip) is not int:
+            try:
+                ip = struct.unpack('!I', socket.inet_aton(ip))[0]
+            except OSError:
+                return None
+        i = bisect.bisect_right(self.starts, ip) - 1
+        if i < 0 or ip > self.ranges[i][1]:
+            return None
+        return self.positions[i] + ip - self.ranges[i][0]
+
+    def set(self, ip, up=None, open=None, seen=None):
+        '''
+        set the state of one ip, None leaves a field as it is
+        return: False if ip is out of the ranges
+
+        '''
+
+        pos = self.index(ip)
+        if pos is None:
+            return False
+        for bits, value in ((self.up, up), (self.open, open)):
+            if value is not None:
+                if value:
+                    bits[pos >> 3] |= 1 << (pos & 7)
+                else:
+                    bits[pos >> 3] &= ~(1 << (pos & 7)) & 255
+        if seen is not None:
+            self.seen[pos] = int(seen)
+        return True
+
+    def fill(self, mydb):
+        '''
+        state from tables host and service of mydb
+        return: self
+
+        '''
+
+        try:
+            mydb.cursor.execute('SELECT ip, stat, timestamp FROM host')
+            for ip, stat, timestamp in mydb.cursor.fetchall():
+                if stat == 'up':
+                    self.set(ip, True, None, timestamp or 0)
+                else:
+                    self.set(ip, False)
+            mydb.cursor.execute('SELECT DISTINCT ip FROM service \
+                WHERE protocol=(?) AND state=(?)', ('tcp', 'open'))
+            for row in mydb.cursor.fetchall():
+                self.set(row[0], None, True)
+        except:
+            raise MyExcept('Error: Fill host state.')
+        return self
+
+    def bits(self, name='up'):
+        '''
+        bitset 'up' or 'open' as int, bit n is position n
+
+        '''
+
+        return int.from_bytes(getattr(self, name), 'little')
+
+    def ips(self, bits):
+        '''
+        yield ip str of every set bit in position order
+
+        '''
+
+        data = bits.to_bytes(self.size // 8, 'little') if type(bits) is int \
+            else bytes(bits)
+        for match in re.finditer(b'[^\\x00]', data): #skip zero bytes
+            byte = match.start()
+            for bit in range(8):
+                if data[byte] >> bit & 1:
+                    pos = 8 * byte + bit
+                    i = bisect.bisect_right(self.positions, pos) - 1
+                    yield socket.inet_ntoa(struct.pack('!I',
+                        self.ranges[i][0] + pos - self.positions[i]))
+
+    def diff(self, older, name='up'):
+        '''
+        compare with older, a state of the same ranges
+        return: (ips set now but not in older, ips set in older only)
+
+        '''
+
+        if older.ranges != self.ranges:
+            raise MyExcept('Error: Host states of different ranges.')
+        now, then = self.bits(name), older.bits(name)
+        return list(self.ips(now & ~then)), list(self.ips(then & ~now))
+
+    def count(self, bits=None, prefix=24):
+        '''
+        set bits per /prefix network, prefix 8 to 29, default bits 'up'
+        return: {'net/prefix': count} of networks with any bit set
+
+        '''
+
+        if bits is None:
+            bits = self.bits('up')
+        data = bits.to_bytes(self.size // 8, 'little') if type(bits) is int \
+            else bytes(bits)
+        step = 1 << (32 - prefix)
+        counts = {}
+        for (first, last), pos in zip(self.ranges, self.positions):
+            net = first - first % step
+            while net <= last:
+                lo = max(first, net) - first + pos #positions of the net
+                hi = min(last, net + step - 1) - first + pos + 1
+                count = bin(int.from_bytes(data[lo >> 3:(hi + 7) >> 3],
+                    'little') >> (lo & 7) & ((1 << (hi - lo)) - 1)).count('1')
+                if count > 0:
+                    key = '%s/%d' %(ipaddress.IPv4Address(net), prefix)
+                    counts[key] = counts.get(key, 0) + count
+                net += step
+        return counts
+
+    def save(self, filename):
+        '''
+        write the state to filename, through a temporary file
+
+        '''
+
+        try:
+            with open(filename + '.tmp', 'wb') as fp:
+                fp.write(self.HEADER.pack(self.MAGIC, len(self.ranges),
+                    self.size))
+                for (first, last), pos in zip(self.ranges, self.positions):
+                    fp.write(self.RANGE.pack(first, last, pos))
+                fp.write(self.up)
+                fp.write(self.open)
+                fp.write(self.seen.tobytes() if type(self.seen) is
+                    array.array else bytes(self.seen))
+            os.replace(filename + '.tmp', filename)
+        except OSError:
+            raise MyExcept('Error: Save host state %s.' %(filename))
+
+    @staticmethod
+    def load(filename):
+        '''
+        map a saved state read-only, set() is not possible on it
+        return: HostState
+
+        '''
+
+        try:
+            with open(filename, 'rb') as fp:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            raise MyExcept('Error: Load host state %s.' %(filename))
+        magic, count, size = HostState.HEADER.unpack_from(mm, 0)
+        if magic != HostState.MAGIC:
+            raise MyExcept('Error: %s is not a host state.' %(filename))
+        offset = HostState.HEADER.size
+        ranges = []
+        for i in range(count):
+            ranges.append(HostState.RANGE.unpack_from(mm,
+                offset + i * HostState.RANGE.size))
+        offset += count * HostState.RANGE.size
+
+        state = HostState.__new__(HostState)
+        state.ranges = [(first, last) for first, last, pos in ranges]
+        state.starts = [first for first, last, pos in ranges]
+        state.positions = [pos for first, last, pos in ranges]
+        state.size = size
+        view = memoryview(mm)
+        state.up = view[offset:offset + size // 8]
+        state.open = view[offset + size // 8:offset + size // 4]
+        state.seen = view[offset + size // 4:offset + size // 4 +
+            4 * size].cast('I')
+        state.mm = mm
+        return state
+
+##############################################################################
+
+
+class Ping:
+    '''
+    ping method
+    
+    '''
+ 
+    DEADLINE = 30 #wall-clock seconds of one ping run
+
+    def win_ping(self, ip):
+        '''
+        windows ping
+        result is affected by denying of ping
+        return {ip:, stat:, timestamp:}, None if ping hangs over DEADLINE
+
+        -------------------------------
+        windows ping output likes this:
+        -------------------------------
+
+        Pinging 10.4.100.177 with 32 bytes of data:
+        Reply from 10.4.100.177: bytes=32 time=2ms TTL=64
+        Reply from 10.4.100.177: bytes=32 time=1ms TTL=64
+        Reply from 10.4.100.177: bytes=32 time=3ms TTL=64
+
+        Ping statistics for 10.4.100.177:
+            Packets: Sent = 3, Received = 3, Lost = 0 (0% loss),
+        Approximate round trip times in milli-seconds:
+            Minimum = 1ms, Maximum = 3ms, Average = 2ms
+
+        '''
+
+        with metrics.timer('ping_seconds'):
+            try:
+                cmd = self.cmd(ip)
+                proc = Watchdog.popen(cmd, stdout=subprocess.PIPE)
+            except:
+                metrics.inc('ping_failures_total')
+                raise MyExcept('Error: ping or ip is not found.')
+            output = Watchdog.communicate(proc, self.DEADLINE)
+
+        if output is None: #hung, no verdict
+            metrics.inc('ping_timeouts_total')
+            print('Timeout with %s' %(ip))
+            return None
+        print('Done with %s' %(ip))
+        record = self.record(ip, output)
+        metrics.inc('ping_total', stat=record['stat'])
+        return record
+
+    def cmd(self, ip):
+        '''
+        windows ping command line
+
+        '''
+
+        return 'ping -n 3 -w 50 ' + ip
+
+    def record(self, ip, output):
+        '''
+        host record from ping's stdout bytes
+
+        '''
+
+        return {'ip': ip,
+            'stat': 'up' if b'TTL' in output else 'down',
+            'timestamp': int(time.time())}
+
+##############################################################################
+
+
+class Watchdog:
+    '''
+    wall-clock deadline for a child process and everything it started
+    children run in their own process group (session on posix), so the
+    whole tree is signalled: terminate first, kill after grace seconds
+
+    '''
+
+    if os.name == 'nt':
+        POPEN = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        POPEN = {'start_new_session': True}
+
+    def __init__(self, proc, deadline, grace=5):
+        self.proc = proc
+        self.grace = grace
+        self.fired = False
+        self.timer = threading.Timer(deadline, self._expire)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _expire(self):
+        self.fired = True
+        Watchdog.kill_tree(self.proc, self.grace)
+
+    def expired(self):
+        return self.fired
+
+    def cancel(self):
+        self.timer.cancel()
+
+    @staticmethod
+    def popen(cmd, **kwargs):
+        '''
+        subprocess.Popen of cmd str in a new process group
+
+        '''
+
+        kwargs.update(Watchdog.POPEN)
+        return subprocess.Popen(cmd.split(), **kwargs)
+
+    @staticmethod
+    def communicate(proc, deadline, grace=5):
+        '''
+        proc.communicate() within deadline seconds
+        return: stdout, None if the tree had to be killed
+
+        '''
+
+        try:
+            return proc.communicate(timeout=deadline)[0]
+        except subprocess.TimeoutExpired:
+            Watchdog.kill_tree(proc, grace)
+            proc.communicate() #reap and close pipes
+            return None
+
+    @staticmethod
+    def kill_tree(proc, grace=5):
+        '''
+        terminate the process tree of proc, kill it after grace seconds
+
+        '''
+
+        Watchdog.signal_tree(proc.pid, grace <= 0)
+        try:
+            proc.wait(timeout=grace)
+        except subprocess.TimeoutExpired:
+            pass
+        Watchdog.signal_tree(proc.pid, True)
+        proc.wait()
+
+    @staticmethod
+    def signal_tree(pid, force):
+        '''
+        terminate (or kill if force) every process of pid's group
+
+        '''
+
+        try:
+            if os.name == 'nt':
+                subprocess.call(['taskkill'] + (['/F'] if force else []) +
+                    ['/T', '/PID', str(pid)], stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(pid, signal.SIGKILL if force else signal.SIGTERM)
+        except (OSError, subprocess.SubprocessError): #already gone
+            pass
+
+
+class Quarantine:
+    '''
+    targets that keep timing out, kept in table quarantine
+    strikes timeouts in a row put a target aside for period seconds,
+    each further timeout doubles the period; a success clears it
+
+    '''
+
+    def __init__(self, mydb, strikes=3, period=86400):
+        self.mydb = mydb
+        self.strikes = strikes
+        self.period = period
+
+    def strike(self, kind, targets):
+        '''
+        count one timeout of each target
+
+        '''
+
+        now = int(time.time())
+        try:
+            self.mydb.cursor.executemany('INSERT INTO quarantine \
+                VALUES(?,?,1,0) ON CONFLICT(kind, target) DO UPDATE SET \
+                strikes=strikes+1', [(kind, target) for target in targets])
+            self.mydb.cursor.executemany('UPDATE quarantine SET until=(?) + \
+                ((?) << MIN(strikes-(?), 10)) WHERE kind=(?) AND \
+                target=(?) AND strikes>=(?)', [(now, self.period,
+                self.strikes, kind, target, self.strikes)
+                    for target in targets])
+            self.mydb.conn.commit()
+        except:
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Quarantine %s.' %(kind))
+
+    def clear(self, kind, targets):
+        '''
+        forget the timeouts of targets that answered
+
+        '''
+
+        try:
+            self.mydb.cursor.executemany('DELETE FROM quarantine \
+                WHERE kind=(?) AND target=(?)',
+                [(kind, target) for target in targets])
+            self.mydb.conn.commit()
+        except:
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Quarantine %s.' %(kind))
+
+    def listed(self, kind):
+        '''
+        targets put aside now
+        return: {target: until}
+
+        '''
+
+        try:
+            self.mydb.cursor.execute('SELECT target, until FROM quarantine \
+                WHERE kind=(?) AND until>(?)', (kind, int(time.time())))
+            return dict(self.mydb.cursor.fetchall())
+        except:
+            raise MyExcept('Error: Quarantine %s.' %(kind))
+
+    def filter(self, kind, targets):
+        '''
+        targets without the ones put aside
+
+        '''
+
+        listed = self.listed(kind)
+        return [target for target in targets if target not in listed]
+
+##############################################################################
+
+
+class Checkpoint:
+    '''
+    crash-safe progress of a long batch run, kept in tables run, runtarget
+    start() resumes the last unfinished run of kind unless resume=False;
+    targets done in this run, or in any run within fresh seconds, are
+    skipped by pending(); cursor is a position the driver saves itself,
+    like the next batch number; finish() closes the run
+
+    '''
+
+    def __init__(self, mydb, kind, fresh=0, resume=True):
+        self.mydb = mydb
+        self.kind = kind
+        self.fresh = fresh
+        self.resume = resume
+        self.runid = None
+        self.cursor = None
+        self.skipped = 0 #targets done by other runs within fresh
+        self.finished = set() #targets done in this run
+        self.recent = set() #targets done by other runs within fresh
+
+    def start(self, total=None):
+        '''
+        open a new run or resume the last unfinished one
+        total: number of targets, for progress()
+        return: run id
+
+        '''
+
+        now = int(time.time())
+        try:
+            rec = None
+            if self.resume:
+                self.mydb.cursor.execute('SELECT id, cursor, skipped FROM run \
+                    WHERE kind=(?) AND finished IS NULL \
+                    ORDER BY started DESC LIMIT 1', (self.kind,))
+                rec = self.mydb.cursor.fetchone()
+            if rec is None:
+                self.runid = '%s-%d-%s' %(self.kind, now,
+                    os.urandom(3).hex())
+                self.cursor, self.skipped = None, 0
+                self.mydb.cursor.execute('INSERT INTO run(id, kind, started, \
+                    updated, total) VALUES(?,?,?,?,?)',
+                    (self.runid, self.kind, now, now, total))
+            else:
+                self.runid, self.cursor, self.skipped = rec
+                if self.cursor is None: #pending() counts them all again
+                    self.skipped = 0
+                self.mydb.cursor.execute('UPDATE run SET updated=(?), \
+                    total=COALESCE((?), total) WHERE id=(?)',
+                    (now, total, self.runid))
+            self.mydb.conn.commit()
+
+            self.mydb.cursor.execute('SELECT target, runid=(?) \
+                FROM runtarget WHERE kind=(?) AND (runid=(?) OR done>=(?))',
+                (self.runid, self.kind, self.runid,
+                    now - self.fresh if self.fresh else None))
+            self.finished, self.recent = set(), set()
+            for target, own in self.mydb.cursor:
+                (self.finished if own else self.recent).add(target)
+        except:
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Start run of %s.' %(self.kind))
+        return self.runid
+
+    def pending(self, targets):
+        '''
+        yield targets not done yet
+        ones done by other runs within fresh count as done in progress(),
+        the count is kept by save(), so pass targets after the saved
+        cursor only
+
+        '''
+
+        for target in targets:
+            if target in self.finished:
+                continue
+            if target in self.recent:
+                self.skipped += 1
+                continue
+            yield target
+
+    def done(self, targets):
+        '''
+        mark targets done in this run, call it after their records are
+        written so a crash in between only scans them again
+
+        '''
+
+        now = int(time.time())
+        targets = list(targets)
+        try:
+            self.mydb.cursor.executemany('REPLACE INTO runtarget \
+                VALUES(?,?,?,?)', [(self.kind, target, self.runid, now)
+                    for target in targets])
+            self.mydb.cursor.execute('UPDATE run SET updated=(?) \
+                WHERE id=(?)', (now, self.runid))
+            self.mydb.conn.commit()
+        except:
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Mark targets of run %s.' %(self.runid))
+        self.finished.update(targets)
+
+    def save(self, cursor):
+        '''
+        persist the driver's position, str or int, with the skip count
+        of the targets before it
+
+        '''
+
+        try:
+            self.mydb.cursor.execute('UPDATE run SET cursor=(?), updated=(?), \
+                skipped=(?) WHERE id=(?)', (str(cursor), int(time.time()),
+                    self.skipped, self.runid))
+            self.mydb.conn.commit()
+        except:
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Save cursor of run %s.' %(self.runid))
+        self.cursor = str(cursor)
+
+    def finish(self):
+        try:
+            self.mydb.cursor.execute('UPDATE run SET finished=(?), \
+                skipped=(?) WHERE id=(?)', (int(time.time()), self.skipped,
+                    self.runid))
+            self.mydb.conn.commit()
+        except:
+            self.mydb.conn.rollback()
+            raise MyExcept('Error: Finish run %s.' %(self.runid))
+
+    def writer(self, write):
+        '''
+        write function for a BatchWriter fed with (records, targets) pairs
+        records go through write, then targets are marked done
+
+        '''
+
+        def flush(items):
+            records = []
+            targets = []
+            for recs, tgts in items:
+                records.extend(recs)
+                targets.extend(tgts)
+            if len(records) > 0:
+                write(records)
+            self.done(targets)
+            return len(records)
+        return flush
+
+    def progress(self, runid=None, window=900):
+        '''
+        progress of runid, default this run or else the last run of kind
+        rate is completions per second over the last window seconds
+        return: {run, total, done, rate, eta, started, updated, finished}
+        or None without any run; eta is seconds, None if unknown
+
+        '''
+
+        try:
+            if runid is None and self.runid is not None:
+                runid = self.runid
+            if runid is None:
+                self.mydb.cursor.execute('SELECT id, started, updated, \
+                    finished, total, skipped FROM run WHERE kind=(?) \
+                    ORDER BY started DESC LIMIT 1', (self.kind,))
+            else:
+                self.mydb.cursor.execute('SELECT id, started, updated, \
+                    finished, total, skipped FROM run WHERE id=(?)', (runid,))
+            rec = self.mydb.cursor.fetchone()
+            if rec is None:
+                return None
+            runid, started, updated, finished, total, skipped = rec
+            self.mydb.cursor.execute('SELECT COUNT(*) FROM runtarget \
+                WHERE runid=(?)', (runid,))
+            done = self.mydb.cursor.fetchone()[0] + (skipped or 0)
+            self.mydb.cursor.execute('SELECT COUNT(*), MIN(done), MAX(done) \
+                FROM runtarget WHERE runid=(?) AND done>=(?)',
+                (runid, (updated or started) - window))
+            count, first, last = self.mydb.cursor.fetchone()
+        except:
+            raise MyExcept('Error: Progress of %s.' %(self.kind))
+
+        rate = None
+        if count > 1 and last > first:
+            rate = float(count) / (last - first)
+        eta = None
+        if finished is not None:
+            eta = 0
+        elif rate and total is not None:
+            eta = int(max(0, total - done) / rate)
+        return {'run': runid, 'total': total, 'done': done, 'rate': rate,
+            'eta': eta, 'started': started, 'updated': updated,
+            'finished': finished}
+
+##############################################################################
+
+
+class Scanner:
+    '''
+    various scan methods by nmap
+    
+    '''
+
+    TAGS = {'os': ('host',), #xml elements each parse_* consumes
+        'ports': ('address', 'port'),
+        'service': ('port', 'host', 'finished'),
+        'services': ('address', 'port', 'host', 'finished'),
+        'discover': ('host',)}
+    DEADLINE = {'os': 900, #wall-clock seconds of one nmap run per kind
+        'ports': 900,
+        'service': 120,
+        'services': 1800, #ports and services may outlast a JobQueue
+        'discover': 1800} #lease, queue drivers hold theirs by keepalive()
+    DISCOVER = {'icmp': '-PE', #host discovery probes per method
+        'arp': '-PR',
+        'tcp': '-PS22,80,135,443,445,3389',
+        'all': '-PE -PS22,80,135,443,445,3389 -PA80,443'}
+    TOPPORTS = 100 #ports = 'top' scans the most common ones, nmap's list
+    NMAP = None #nmap -V of this process, checked by the first Scanner
+
+    def __init__(self, deadline=None, maxrate=None):
+        '''
+        check if nmap existe, once per process
+        deadline: {kind: seconds} overriding DEADLINE
+        maxrate: packets per second cap of every nmap run, None for none
+        
+        '''
+
+        self.deadline = dict(self.DEADLINE)
+        self.deadline.update(deadline or {})
+        self.maxrate = maxrate
+        self.timedout = []
+        if Scanner.NMAP is not None:
+            return
+
+        try:
+            cmd = 'nmap -V'
+            proc = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE)
+        except:
+            raise MyExcept('Error: nmap was not found in path.')
+
+        nmap_output = proc.communicate()[0] #sav stdout
+        if b'Nmap version' not in nmap_output:
+            raise MyExcept('Error: nmap was not found in path.')
+        Scanner.NMAP = nmap_output.decode(errors='replace').split('\n')[0]
+
+    def take_timedout(self):
+        '''
+        targets whose nmap run hit its deadline since the last call
+
+        '''
+
+        timedout, self.timedout = self.timedout, []
+        return timedout
+
+    def scan_os(self, ip):
+        '''
+        guess host's os info by nmap scan
+        return: dict record
+        
+        ---------------------------
+        nmap xml output likes this:
+        ---------------------------
+
+        <?xml version="1.0" encoding="UTF-8"?>
+        <!DOCTYPE nmaprun>
+        <?xml-stylesheet href="file:///C:/Program Files (x86)/Nmap/nmap.xsl" type="text/xsl"?>
+        <!-- Nmap 7.40 scan initiated Sun Feb 05 12:04:03 2017 as: nmap -oX - -O --osscan-limit 192.168.5.1 -->
+        <nmaprun scanner="nmap" args="nmap -oX - -O --osscan-limit 192.168.5.1" start="1486267443" startstr="Sun Feb 05 12:04:03 2017" version="7.40" xmloutputversion="1.04">
+            <scaninfo type="syn" protocol="tcp" numservices="1000" services="1,3-4,6-7,9,13,17,19-26,30,32-33,37,42-43,49,53,70,79-85,88-90,99-100,106,109-111,113,119,125,135,139,143-144,146,161,163,179,199,211-212,222,254-256,259,264,280,301,306,311,340,366,389,406-407,416-417,425,427,443-445,458,464-465,481,497,500,512-515,524,541,543-545,548,554-555,563,587,593,616-617,625,631,636,646,648,666-668,683,687,691,700,705,711,714,720,722,726,749,765,777,783,787,800-801,808,843,873,880,888,898,900-903,911-912,981,987,990,992-993,995,999-1002,1007,1009-1011,1021-1100,1102,1104-1108,1110-1114,1117,1119,1121-1124,1126,1130-1132,1137-1138,1141,1145,1147-1149,1151-1152,1154,1163-1166,1169,1174-1175,1183,1185-1187,1192,1198-1199,1201,1213,1216-1218,1233-1234,1236,1244,1247-1248,1259,1271-1272,1277,1287,1296,1300-1301,1309-1311,1322,1328,1334,1352,1417,1433-1434,1443,1455,1461,1494,1500-1501,1503,1521,1524,1533,1556,1580,1583,1594,1600,1641,1658,1666,1687-1688,1700,1717-1721,1723,1755,1761,1782-1783,1801,1805,1812,1839-1840,1862-1864,1875,1900,1914,1935,1947,1971-1972,1974,1984,1998-2010,2013,2020-2022,2030,2033-2035,2038,2040-2043,2045-2049,2065,2068,2099-2100,2103,2105-2107,2111,2119,2121,2126,2135,2144,2160-2161,2170,2179,2190-2191,2196,2200,2222,2251,2260,2288,2301,2323,2366,2381-2383,2393-2394,2399,2401,2492,2500,2522,2525,2557,2601-2602,2604-2605,2607-2608,2638,2701-2702,2710,2717-2718,2725,2800,2809,2811,2869,2875,2909-2910,2920,2967-2968,2998,3000-3001,3003,3005-3007,3011,3013,3017,3030-3031,3052,3071,3077,31278,63331,64623,64680,65000,65129,65389"/>
+            <verbose level="0"/>
+            <debugging level="0"/>
+            <host starttime="1486267444" endtime="1486267451">
+                <status state="up" reason="arp-response" reason_ttl="0"/>
+                <address addr="192.168.5.1" addrtype="ipv4"/>
+                <address addr="78:C1:A7:0B:43:32" addrtype="mac" vendor="zte"/>
+                <hostnames></hostnames>
+                <ports>
+                    <extraports state="closed" count="996"><extrareasons reason="resets" count="996"/></extraports>
+                    <port protocol="tcp" portid="53"><state state="open" reason="syn-ack" reason_ttl="64"/><service name="domain" method="table" conf="3"/></port>
+                    <port protocol="tcp" portid="80"><state state="open" reason="syn-ack" reason_ttl="64"/><service name="http" method="table" conf="3"/></port>
+                    <port protocol="tcp" portid="7777"><state state="open" reason="syn-ack" reason_ttl="64"/><service name="cbt" method="table" conf="3"/></port>
+                    <port protocol="tcp" portid="52869"><state state="open" reason="syn-ack" reason_ttl="64"/><service name="unknown" method="table" conf="3"/></port>
+                </ports>
+                <os>
+                    <portused state="open" proto="tcp" portid="53"/>
+                    <portused state="closed" proto="tcp" portid="1"/>
+                    <portused state="closed" proto="udp" portid="35682"/>
+                    <osmatch name="Linux 2.6.32 - 3.10" accuracy="100" line="53646">
+                        <osclass type="general purpose" vendor="Linux" osfamily="Linux" osgen="2.6.X" accuracy="100"><cpe>cpe:/o:linux:linux_kernel:2.6</cpe></osclass>
+                        <osclass type="general purpose" vendor="Linux" osfamily="Linux" osgen="3.X" accuracy="100"><cpe>cpe:/o:linux:linux_kernel:3</cpe></osclass>
+                    </osmatch>
+                </os>
+                <uptime seconds="1179974" lastboot="Sun Jan 22 20:17:57 2017"/>
+                <distance value="1"/>
+                <tcpsequence index="258" difficulty="Good luck!" values="A0D96948,F32FE618,9944DBDB,C0BE68C8,15CA9851,3FCCDE8"/>
+                <ipidsequence class="All zeros" values="0,0,0,0,0,0"/>
+                <tcptssequence class="100HZ" values="7087F02,7087F0D,7087F18,7087F23,7087F2E,7087F39"/>
+                <times srtt="15960" rttvar="28032" to="128088"/>
+            </host>
+            <runstats>
+                <finished time="1486267451" timestr="Sun Feb 05 12:04:11 2017" elapsed="8.36" summary="Nmap done at Sun Feb 05 12:04:11 2017; 1 IP address (1 host up) scanned in 8.36 seconds" exit="success"/>
+                <hosts up="1" down="0" total="1"/>
+            </runstats>
+        </nmaprun>
+        
+        '''
+
+        cmd = self._nmap() + '-Pn -O --osscan-limit --host-timeout 360 ' + ip
+
+        record = None
+        for host in self._scan(cmd, 'os', 'Error: nmap os scan.', [ip]):
+            if record is None: #only the first host counts
+                record = self._os_record(host, ip)
+        if record is None:
+            return None
+        print('Done with %s' %(ip))
+        return record
+
+    def scan_os_batch(self, targets, hostgroup=None):
+        '''
+        guess os info of a group of hosts by one nmap scan
+        targets likes ['ipa', 'ipb', 'ipc/24'], nmap parallelizes them itself
+        hostgroup: nmap --min-hostgroup, default is len(targets)
+        return: list of dict record, one per <host> with an osmatch
+
+        '''
+
+        result = list(self.iter_os(targets, hostgroup))
+        print('Done with %s' %(' '.join(targets)))
+        return result
+
+    def iter_os(self, targets, hostgroup=None):
+        '''
+        like scan_os_batch, but yields each record as soon as its <host> closes
+
+        '''
+
+        if len(targets) == 0:
+            return iter([])
+        return self.parse_os(self._scan(self.cmd_os(targets, hostgroup), 'os',
+            'Error: nmap os scan.', targets))
+
+    def _nmap(self):
+        '''
+        head of every nmap command line, with the --max-rate cap if set
+
+        '''
+
+        if self.maxrate:
+            return 'nmap -oX - --max-rate ' + str(int(self.maxrate)) + ' '
+        return 'nmap -oX - '
+
+    def cmd_os(self, targets, hostgroup=None):
+        '''
+        nmap command line of iter_os
+
+        '''
+
+        if hostgroup is None:
+            hostgroup = len(targets)
+        return self._nmap() + '-Pn -O --osscan-limit --host-timeout 360 ' + \
+            '--min-hostgroup ' + str(hostgroup) + ' ' + ' '.join(targets)
+
+    def parse_os(self, elems):
+        '''
+        os records from elements of TAGS['os']
+
+        '''
+
+        for host in elems:
+            address = host.find('address[@addrtype="ipv4"]')
+            if address is None:
+                continue
+            record = self._os_record(host, address.get('addr'))
+            if record is not None:
+                yield record
+
+    def _os_record(self, host, ip):
+        '''
+        build os record from one <host> element
+        return: dict record or None
+
+        '''
+
+        if host is None:
+            return None
+        if host.find('os/osmatch') is None:
+            return None
+        record = {'ip': ip,
+            'osname': host.find('os/osmatch').get('name')}
+        osclass = host.find('os/osmatch/osclass')
+        if osclass is not None:
+            record['osvendor'] = osclass.get('vendor')
+            record['osfamily'] = osclass.get('osfamily')
+            record['osgen'] = osclass.get('osgen')
+            record['osaccuracy'] = int(osclass.get('accuracy'))
+        return record
+
+    def scan_ports_tcp(self, ip, ports=None):
+        '''
+        only detects port's state, not service's version.
+        return only open or open|filtered ports
+        ports: None for 1-65535, 'top' for TOPPORTS, or likes '1-4096'
+        
+        '''
+
+        result = list(self.iter_ports_tcp([ip], ports)) #all ports' information
+        if len(result) == 0:
+            return None
+        else:
+            return result
+
+    def iter_ports_tcp(self, targets, ports=None):
+        '''
+        like scan_ports_tcp over many targets
+        yields each open port record as soon as its <port> closes
+
+        '''
+
+        if len(targets) == 0:
+            return iter([])
+        return self.parse_ports(self._scan(self.cmd_ports(targets, ports),
+            'ports', 'Error: tcp ports fast scan error.', targets))
+
+    def cmd_ports(self, targets, ports=None):
+        '''
+        nmap command line of iter_ports_tcp
+
+        '''
+
+        if ports is None:
+            ports = '-p 1-65535'
+        elif ports == 'top':
+            ports = '--top-ports ' + str(self.TOPPORTS)
+        else:
+            ports = '-p ' + ports
+        return self._nmap() + '-Pn ' + ports + \
+            ' -sS -T4 --host-timeout 360 ' + ' '.join(targets)
+
+    @staticmethod
+    def chunk(number, chunks):
+        '''
+        ports of chunk number, from 0, of 1-65535 cut in chunks parts
+        return: likes '1-4096'
+
+        '''
+
+        size = -(-65535 // chunks)
+        first = number * size + 1
+        return '%d-%d' %(first, min(65535, first + size - 1))
+
+    def parse_ports(self, elems):
+        '''
+        open port records from elements of TAGS['ports']
+
+        '''
+
+        ip = None
+        for elem in elems:
+            if elem.tag == 'address':
+                if elem.get('addrtype') == 'ipv4':
+                    ip = elem.get('addr')
+                continue
+            dport = {'ip': ip,
+                'portid': int(elem.get('portid')),
+                'protocol': 'tcp',
+                'state': elem.find('state').get('state'),
+                #'reason': elem.find('state').get('reason'),
+            }
+            if 'open' not in dport['state']:
+                continue
+            #if elem.find('service') is not None:
+                #dport['servname'] = elem.find('service').get('name')
+            yield dport
+
+    def scan_service_tcp(self, ip, port):
+        '''
+        guess one service info by one given ip & one given TCP port
+
+        '''
+
+        return self.parse_service(self._scan(self.cmd_service(ip, port), 'service',
+            'Error: nmap port scan.', [ip]), ip, port)
+
+    def cmd_service(self, ip, port):
+        '''
+        nmap command line of scan_service_tcp
+
+        '''
+
+        return self._nmap() + '-Pn -p ' + str(port) + ' -T4 -sV --version-light --host-timeout 20 ' + ip
+
+    def parse_service(self, elems, ip, port):
+        '''
+        service record from elements of TAGS['service']
+
+        '''
+
+        result = None
+        for elem in elems:
+            if elem.tag == 'host':
+                if result is None:
+                    result = {'ip': ip, 'portid': port, 'protocol': 'tcp'}
+            elif elem.tag == 'finished':
+                if result is not None:
+                    result['timestamp'] = int(elem.get('time'))
+            elif result is None: #first port of first host
+                result = {'ip': ip, 'portid': port, 'protocol': 'tcp'}
+                result.update(self._service_fields(elem))
+
+        return result #None if host is down
+
+    def scan_services_tcp(self, targets):
+        '''
+        guess service info of many ports of many hosts by one nmap scan
+        targets likes {'ipa': [22, 80], 'ipb': [443]}
+        return: list of service record, one per asked port of up hosts
+
+        '''
+
+        if len(targets) == 0:
+            return []
+        return list(self.parse_services(self._scan(self.cmd_services(targets), 'services',
+            'Error: nmap port scan.', list(targets)), targets))
+
+    def cmd_services(self, targets):
+        '''
+        nmap command line of scan_services_tcp
+        every host is probed on the union of ports, parse_services filters
+
+        '''
+
+        ports = set()
+        for portlist in targets.values():
+            ports.update([int(port) for port in portlist])
+        hosttimeout = 20 + 5 * (len(ports) - 1) #20s was for one port
+        return self._nmap() + '-Pn -p ' + ','.join([str(port) for port in sorted(ports)]) + \
+            ' -T4 -sV --version-light --host-timeout ' + str(hosttimeout) + \
+            ' ' + ' '.join(targets.keys())
+
+    def parse_services(self, elems, targets):
+        '''
+        service records from elements of TAGS['services']
+        records are held until <finished> gives their timestamp
+
+        '''
+
+        ip = None
+        records = {}
+        timestamp = None
+        for elem in elems:
+            if elem.tag == 'address':
+                if elem.get('addrtype') == 'ipv4':
+                    ip = elem.get('addr')
+            elif elem.tag == 'port':
+                portid = int(elem.get('portid'))
+                if ip in targets and portid in targets[ip]:
+                    record = {'ip': ip, 'portid': portid, 'protocol': 'tcp'}
+                    record.update(self._service_fields(elem))
+                    records[(ip, portid)] = record
+            elif elem.tag == 'host':
+                for portid in targets.get(ip, []): #up, but port not listed
+                    if (ip, int(portid)) not in records:
+                        records[(ip, int(portid))] = {'ip': ip,
+                            'portid': int(portid), 'protocol': 'tcp'}
+                ip = None
+            elif elem.tag == 'finished':
+                timestamp = int(elem.get('time'))
+
+        for record in records.values():
+            record['timestamp'] = timestamp
+            yield record
+
+    def discover(self, targets, method='icmp'):
+        '''
+        host discovery of whole networks by one nmap -sn run
+        targets likes ['ipa/24', 'ipb', 'ipc-ipd'], as asset.lst
+        method: key of DISCOVER
+        return: list of {ip, stat, timestamp}, like Ping().win_ping, for
+        every target; targets nmap does not report are down, addresses
+        Targets leaves out (network, broadcast) are dropped
+
+        '''
+
+        planned = Targets(targets)
+        seen = set()
+        result = []
+        for record in self.iter_discover(targets, method):
+            if record['ip'] in planned and record['ip'] not in seen:
+                seen.add(record['ip'])
+                result.append(record)
+        now = int(time.time())
+        for ip in planned:
+            if ip not in seen:
+                result.append({'ip': ip, 'stat': 'down', 'timestamp': now})
+        print('Done with %s' %(' '.join(targets)))
+        return result
+
+    def iter_discover(self, targets, method='icmp'):
+        '''
+        like discover, but yields only hosts nmap reports, as they close
+
+        '''
+
+        if len(targets) == 0:
+            return iter([])
+        return self.parse_discover(self._scan(self.cmd_discover(targets, method),
+            'discover', 'Error: nmap host discovery.', targets))
+
+    def cmd_discover(self, targets, method='icmp'):
+        '''
+        nmap command line of iter_discover
+        -v lists down hosts as well, -n skips dns
+        full a-b ranges are expanded, nmap only knows a-lastoctet
+
+        '''
+
+        if method not in self.DISCOVER:
+            raise MyExcept('Error: Unknown discovery method %s.' %(method))
+        nets = []
+        for net in targets:
+            if '-' in net and '.' in net.split('-', 1)[1]: #nmap lacks a-b
+                nets.extend(Targets([net]))
+            else:
+                nets.append(net)
+        return self._nmap() + '-sn -n -v ' + self.DISCOVER[method] + ' ' + \
+            ' '.join(nets)
+
+    def parse_discover(self, elems):
+        '''
+        host records from elements of TAGS['discover']
+
+        '''
+
+        for host in elems:
+            address = host.find('address[@addrtype="ipv4"]')
+            status = host.find('status')
+            if address is None or status is None:
+                continue
+            yield {'ip': address.get('addr'),
+                'stat': 'up' if status.get('state') == 'up' else 'down',
+                'timestamp': int(time.time())}
+
+    def _service_fields(self, port):
+        '''
+        state and service columns from one <port> element
+
+        '''
+
+        fields = {'state': port.find('state').get('state'),
+            'reason': port.find('state').get('reason')}
+        if port.find('service') is not None:
+            fields['servname'] = port.find('service').get('name')
+            fields['product'] = port.find('service').get('product')
+            fields['version'] = port.find('service').get('version')
+        return fields
+
+    def _scan(self, cmd, kind, msg, targets):
+        '''
+        run nmap with xml output on its stdout pipe and parse it on the fly
+        yields elements of TAGS[kind], see _iterparse
+        msg: MyExcept message if nmap can not be started
+        a run over DEADLINE[kind] is killed, yields what it had and adds
+        targets to timedout
+
+        '''
+
+        try:
+            proc = Watchdog.popen(cmd, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL)
+        except:
+            metrics.inc('nmap_failures_total', kind=kind)
+            raise MyExcept(msg)
+        watchdog = Watchdog(proc, self.deadline[kind])
+
+        enabled = metrics.enabled
+        stream = _TimedReader(proc.stdout) if enabled else proc.stdout
+        start = time.perf_counter()
+        consumer = 0
+        try:
+            for elem in self._iterparse(stream, self.TAGS[kind],
+                    watchdog.expired):
+                if enabled:
+                    yielded = time.perf_counter()
+                yield elem
+                if enabled:
+                    consumer += time.perf_counter() - yielded
+            proc.wait()
+            if enabled:
+                metrics.observe('nmap_seconds', stream.waited, kind=kind)
+                metrics.observe('parse_seconds', time.perf_counter() - \
+                    start - consumer - stream.waited, kind=kind)
+                if proc.returncode != 0:
+                    metrics.inc('nmap_failures_total', kind=kind)
+        finally:
+            watchdog.cancel()
+            proc.stdout.close()
+            if proc.poll() is None: #consumer stopped early
+                Watchdog.kill_tree(proc, 0)
+            if watchdog.expired():
+                self.timedout.extend(targets)
+                metrics.inc('nmap_timeouts_total', kind=kind)
+
+    def _iterparse(self, stream, tags, truncated=None):
+        '''
+        incremental nmap xml parser
+        yields each element whose tag is in tags when it closes, then frees it
+        every closed <host> is dropped, so memory does not grow with output
+        truncated: returns True if the output was cut off on purpose, then
+        a broken end of xml just stops the parsing
+
+        '''
+
+        try:
+            context = ET.iterparse(stream, events=('start', 'end'))
+            event, root = next(context)
+            for event, elem in context:
+                if event != 'end':
+                    continue
+                if elem.tag in tags:
+                    yield elem
+                    elem.clear()
+                if elem.tag == 'host':
+                    root.clear()
+        except (ET.ParseError, StopIteration): #empty output also raises
+            if truncated is not None and truncated():
+                return
+            raise MyExcept('Error: nmap output.')
+
+##############################################################################
+
+
+class FingerprintCache:
+    '''
+    product and version of (ip, port) from the last -sV probe, reused as
+    long as a cheap digest of the port matches: a tcp connect and the
+    first line the service sends by itself (ssh, ftp, smtp banners), or
+    only that it is silent. entries expire after ttl seconds, the least
+    recently used go beyond size
+    stats() gives hits, misses, changed and expired, also in metrics
+
+    '''
+
+    FIELDS = ('servname', 'product', 'version')
+
+    def __init__(self, ttl=7*86400, size=100000):
+        self.ttl = ttl
+        self.size = size
+        #(ip, port): (digest, fields, expires), least recently used first
+        self.entries = collections.OrderedDict()
+        self.counts = {'hit': 0, 'miss': 0, 'changed': 0, 'expired': 0}
+
+    def lookup(self, ip, port, digest, now=None):
+        '''
+        return: cached fields of (ip, port) if digest matches, else None
+
+        '''
+
+        if now is None:
+            now = time.time()
+        entry = self.entries.get((ip, port))
+        if entry is None or digest is None:
+            result = 'miss'
+        elif entry[0] != digest:
+            result = 'changed'
+        elif entry[2] < now:
+            result = 'expired'
+        else:
+            result = 'hit'
+            self.entries.move_to_end((ip, port))
+        self.counts[result] += 1
+        metrics.inc('fingerprint_cache_total', result=result)
+        return dict(entry[1]) if result == 'hit' else None
+
+    def store(self, ip, port, digest, record, now=None):
+        '''
+        keep the FIELDS of a probed service record under digest
+
+        '''
+
+        if digest is None:
+            return
+        if now is None:
+            now = time.time()
+        self.entries[(ip, port)] = (digest,
+            dict([(col, record.get(col)) for col in self.FIELDS]),
+            now + self.ttl)
+        self.entries.move_to_end((ip, port))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        '''
+        return: counts of lookups by result, size and hit rate
+
+        '''
+
+        total = sum(self.counts.values())
+        result = dict(self.counts)
+        result['size'] = len(self.entries)
+        result['hitrate'] = float(self.counts['hit']) / total if total else 0.0
+        return result
+
+    def digests(self, targets, timeout=2, wait=1, concurrency=100):
+        '''
+        digest of every port of targets likes {'ip': [ports]}
+        return: {(ip, port): digest}, None where the port did not answer
+
+        '''
+
+        return asyncio.run(self._digests(targets, timeout, wait,
+            concurrency))
+
+    async def _digests(self, targets, timeout, wait, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def digest(ip, port):
+            async with semaphore:
+                try:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(ip, port), timeout)
+                except (OSError, asyncio.TimeoutError):
+                    return (ip, port), None
+                try:
+                    banner = await asyncio.wait_for(reader.readline(), wait)
+                except (OSError, asyncio.TimeoutError, ValueError):
+                    banner = b''
+                finally:
+                    writer.close()
+                if banner == b'':
+                    return (ip, port), 'silent'
+                return (ip, port), '%08x' %(zlib.crc32(banner.strip()))
+
+        return dict(await asyncio.gather(*[digest(ip, int(port))
+            for ip, ports in targets.items() for port in ports]))
+
+##############################################################################
+
+
+class Throttle:
+    '''
+    self-tuning limit of in-flight probes, with packets per second caps
+    every window probes the median latency is held against the best seen
+    so far: the limit doubles (slow start) until the first backoff, then
+    grows by one; it shrinks by backoff when latency inflates without a
+    gain in throughput, the timeout rate is too high or memory runs short,
+    and holds while the cpus are busy (the probes themselves load them).
+    pps caps all probes, subnetpps each /prefix network.
+
+    '''
+
+    def __init__(self, initial=32, minimum=1, maximum=1000, window=20,
+            timeoutrate=0.05, inflation=2.0, backoff=0.7, pps=None,
+            subnetpps=None, prefix=24):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(maximum, initial))
+        self.window = window
+        self.timeoutrate = timeoutrate
+        self.inflation = inflation
+        self.backoff = backoff
+        self.pps = pps
+        self.subnetpps = subnetpps
+        self.mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+        self.slowstart = True
+        self.best = None
+        self.samples = []
+        self.timeouts = 0
+        self.started = time.time()
+        self.throughput = 0
+        self.slot = 0 #next free time of the global cap
+        self.subnets = {} #next free time per subnet
+        self.load = (0, (False, False))
+        self.cputimes = None #(idle, total) of the last windows reading
+        self.blind = False #neither cpu nor memory can be read here
+
+    def reserve(self, target, packets=1):
+        '''
+        book packets of one probe to target under the pps caps
+        return: seconds to wait before sending
+
+        '''
+
+        now = time.time()
+        start = now
+        if self.pps:
+            start = max(start, self.slot)
+        if self.subnetpps:
+            try:
+                subnet = int(ipaddress.IPv4Address(target)) & self.mask
+            except ValueError:
+                subnet = target
+            start = max(start, self.subnets.get(subnet, 0))
+            self.subnets[subnet] = start + float(packets) / self.subnetpps
+            if len(self.subnets) > 65536: #forget subnets long idle
+                self.subnets = dict([(key, due) for key, due in
+                    self.subnets.items() if due > now])
+        if self.pps:
+            self.slot = start + float(packets) / self.pps
+        return start - now
+
+    def record(self, latency, timedout=False):
+        '''
+        one finished probe, adjust the limit every window probes
+        return: the limit
+
+        '''
+
+        self.samples.append(latency)
+        self.timeouts += 1 if timedout else 0
+        if len(self.samples) < self.window:
+            return self.limit
+
+        now = time.time()
+        median = sorted(self.samples)[len(self.samples) // 2]
+        rate = float(self.timeouts) / len(self.samples)
+        throughput = len(self.samples) / max(now - self.started, 1e-6)
+        gained = throughput > self.throughput * 1.1
+        self.samples = []
+        self.timeouts = 0
+        self.started = now
+        self.throughput = throughput
+        if self.best is None or median < self.best:
+            self.best = median
+
+        busy, short = self._loaded()
+        if rate > self.timeoutrate or short or \
+                (median > self.best * self.inflation and not gained):
+            self.slowstart = False
+            self.limit = max(self.minimum, int(self.limit * self.backoff))
+        elif busy:
+            self.slowstart = False
+        elif self.slowstart:
+            self.limit = min(self.maximum, self.limit * 2)
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+        return self.limit
+
+    def _loaded(self):
+        '''
+        return: (busy, short), cpus saturated and memory nearly gone;
+        read at most every 5 seconds, False if unreadable
+        posix: load average over twice the cpus, /proc/meminfo
+        windows: cpu time over 95% since the last reading, by
+        GetSystemTimes, and GlobalMemoryStatusEx
+
+        '''
+
+        now = time.time()
+        if now - self.load[0] < 5:
+            return self.load[1]
+        if os.name == 'nt':
+            busy, short = self._cpu_nt(), self._memory_nt()
+        else:
+            busy, short = self._cpu_posix(), self._memory_posix()
+        if busy is None and short is None and not self.blind:
+            self.blind = True
+            print('Throttle: no cpu or memory readings on this system, '
+                'only latency and timeouts steer the limit')
+        self.load = (now, (bool(busy), bool(short)))
+        return self.load[1]
+
+    def _cpu_posix(self):
+        try:
+            return os.getloadavg()[0] > 2 * (os.cpu_count() or 1)
+        except (AttributeError, OSError):
+            return None
+
+    def _memory_posix(self):
+        try:
+            with open('/proc/meminfo') as fp:
+                info = dict([(line.split(':')[0], int(line.split()[1]))
+                    for line in fp if len(line.split()) > 1])
+            return info['MemAvailable'] < 0.05 * info['MemTotal']
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _cpu_nt(self):
+        try:
+            idle, kernel, user = [ctypes.c_ulonglong() for _ in range(3)]
+            if not ctypes.windll.kernel32.GetSystemTimes(ctypes.byref(idle),
+                    ctypes.byref(kernel), ctypes.byref(user)):
+                return None
+        except (AttributeError, OSError):
+            return None
+        last = self.cputimes #kernel time includes idle time
+        self.cputimes = (idle.value, kernel.value + user.value)
+        if last is None or self.cputimes[1] <= last[1]:
+            return False
+        return 1 - float(self.cputimes[0] - last[0]) / \
+            (self.cputimes[1] - last[1]) > 0.95
+
+    def _memory_nt(self):
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                ('dwMemoryLoad', ctypes.c_ulong),
+                ('ullTotalPhys', ctypes.c_ulonglong),
+                ('ullAvailPhys', ctypes.c_ulonglong),
+                ('ullTotalPageFile', ctypes.c_ulonglong),
+                ('ullAvailPageFile', ctypes.c_ulonglong),
+                ('ullTotalVirtual', ctypes.c_ulonglong),
+                ('ullAvailVirtual', ctypes.c_ulonglong),
+                ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        try:
+            if not ctypes.windll.kernel32.GlobalMemoryStatusEx(
+                    ctypes.byref(status)):
+                return None
+        except (AttributeError, OSError):
+            return None
+        return status.ullAvailPhys < 0.05 * status.ullTotalPhys
+
+##############################################################################
+
+
+class AsyncRunner:
+    '''
+    run Ping and Scanner probes as asyncio subprocesses from one process
+    each probe kind has its own concurrency limit and per-task timeout
+    records are the same dicts as Ping().win_ping and Scanner().scan_*
+
+    adaptive: let a Throttle per run tune the limit up to concurrency
+    pps, subnetpps: packets per second caps, global and per /24
+
+    kind      target               record
+    ping      'ip'                 {ip, stat, timestamp}
+    os        ['ipa', 'ipb/24']    [os records]
+    ports     'ip'                 [open port records]
+    service   ('ip', port)         service record
+    services  {'ip': [ports]}      [service records]
+
+    '''
+
+    CONCURRENCY = {'ping': 1000, 'os': 10, 'ports': 20, 'service': 50,
+        'services': 20}
+    TIMEOUT = {'ping': 10, 'os': 900, 'ports': 900, 'service': 60,
+        'services': 900}
+    PACKETS = {'ping': 3, 'os': 1200, 'ports': 2000, 'service': 50,
+        'services': 200} #rough packets per probe, for the pps caps
+
+    def __init__(self, concurrency=None, timeout=None, scanner=None,
+            adaptive=False, pps=None, subnetpps=None):
+        self.concurrency = dict(self.CONCURRENCY)
+        self.concurrency.update(concurrency or {})
+        self.timeout = dict(self.TIMEOUT)
+        self.timeout.update(timeout or {})
+        self.adaptive = adaptive
+        self.pps = pps
+        self.subnetpps = subnetpps
+        self.ping = Ping()
+        self.scanner = scanner #Scanner() checks nmap, so only if needed
+        self.timeouts = 0
+        self.failures = 0
+        self.throttle = None
+
+    def run(self, kind, targets, callback=None, window=10000):
+        '''
+        probe all targets, blocking until done
+        callback(record) is called as each probe completes, in any order
+        at most window tasks exist at a time, so targets may be a generator
+        return: number of completed probes
+
+        '''
+
+        if kind not in self.CONCURRENCY:
+            raise MyExcept('Error: Unknown probe %s.' %(kind))
+        if kind != 'ping' and self.scanner is None:
+            self.scanner = Scanner()
+        if kind != 'ping' and self.subnetpps: #one nmap stays under it
+            self.scanner.maxrate = min(self.subnetpps,
+                self.scanner.maxrate or self.subnetpps)
+        maximum = self.concurrency[kind]
+        if self.adaptive:
+            self.throttle = Throttle(min(32, maximum), 1, maximum,
+                pps=self.pps, subnetpps=self.subnetpps)
+        else:
+            self.throttle = Throttle(maximum, maximum, maximum,
+                pps=self.pps, subnetpps=self.subnetpps)
+        return asyncio.run(self._run(kind, targets, callback, window))
+
+    async def _run(self, kind, targets, callback, window):
+        self.slots = asyncio.Condition()
+        self.inflight = 0
+        probe = getattr(self, '_' + kind)
+        pending = set()
+        count = 0
+        try:
+            for target in targets:
+                pending.add(asyncio.ensure_future(probe(target)))
+                if len(pending) >= window:
+                    count += await self._drain(pending, callback,
+                        asyncio.FIRST_COMPLETED)
+            while len(pending) > 0:
+                count += await self._drain(pending, callback,
+                    asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending: #interrupted, kill what is still running
+                task.cancel()
+            if len(pending) > 0:
+                await asyncio.gather(*pending, return_exceptions=True)
+        return count
+
+    async def _drain(self, pending, callback, when):
+        done, _ = await asyncio.wait(pending, return_when=when)
+        for task in done:
+            pending.discard(task)
+            record = task.result()
+            if callback is not None and record is not None:
+                callback(record)
+        return len(done)
+
+    async def _acquire(self, kind, target):
+        '''
+        wait for a slot under the throttle's limit and for its pps caps
+
+        '''
+
+        async with self.slots:
+            while self.inflight >= self.throttle.limit:
+                await self.slots.wait()
+            self.inflight += 1
+        delay = self.throttle.reserve(target, self.PACKETS[kind])
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _release(self, kind, latency, timedout):
+        self.throttle.record(latency, timedout)
+        metrics.set('concurrency_limit', self.throttle.limit, kind=kind)
+        async with self.slots:
+            self.inflight -= 1
+            self.slots.notify_all()
+
+    async def _exec(self, kind, cmd, target):
+        '''
+        run one command under the kind's throttle and timeout
+        target: ip the pps caps are counted on
+        return: stdout bytes, None on timeout or failure
+
+        '''
+
+        await self._acquire(kind, target)
+        start = time.perf_counter()
+        timedout = False
+        try:
+            try:
+                proc = await asyncio.create_subprocess_exec(*cmd.split(),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL, **Watchdog.POPEN)
+            except OSError:
+                self.failures += 1
+                metrics.inc('probe_failures_total', kind=kind)
+                return None
+            try:
+                return (await asyncio.wait_for(
+                    proc.communicate(), self.timeout[kind]))[0]
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                timedout = True
+                metrics.inc('probe_timeouts_total', kind=kind)
+                return None
+            finally:
+                if proc.returncode is None: #timed out or cancelled
+                    Watchdog.signal_tree(proc.pid, True)
+                    await proc.wait()
+        finally:
+            await self._release(kind, time.perf_counter() - start, timedout)
+
+    def _parse(self, kind, output):
+        return self.scanner._iterparse(io.BytesIO(output),
+            self.scanner.TAGS[kind])
+
+    async def _ping(self, ip):
+        output = await self._exec('ping', self.ping.cmd(ip), ip)
+        if output is None:
+            return None
+        return self.ping.record(ip, output)
+
+    async def _os(self, targets):
+        output = await self._exec('os', self.scanner.cmd_os(targets),
+            targets[0])
+        if output is None:
+            return None
+        return list(self.scanner.parse_os(self._parse('os', output)))
+
+    async def _ports(self, ip):
+        output = await self._exec('ports', self.scanner.cmd_ports([ip]), ip)
+        if output is None:
+            return None
+        return list(self.scanner.parse_ports(self._parse('ports', output)))
+
+    async def _service(self, target):
+        ip, port = target
+        output = await self._exec('service',
+            self.scanner.cmd_service(ip, port), ip)
+        if output is None:
+            return None
+        return self.scanner.parse_service(
+            self._parse('service', output), ip, port)
+
+    async def _services(self, targets):
+        output = await self._exec('services',
+            self.scanner.cmd_services(targets), next(iter(targets)))
+        if output is None:
+            return None
+        return list(self.scanner.parse_services(
+            self._parse('services', output), targets))
+
+##############################################################################
+
+
+class Coordinator:
+    '''
+    hand shards of targets to remote Worker over tcp, write what they
+    send back into one MyDB
+    protocol is one json object per line:
+      coordinator -> worker  {op: task, id, kind, targets} or {op: bye}
+      worker -> coordinator  {op: record, id, record} and {op: done, id}
+    a shard comes back to the pending queue when its worker disconnects
+    or sends nothing for tasktimeout seconds, so other workers take it
+    records whose ip is not in the shard they were sent for are dropped
+    listens on localhost only; for remote workers pass host='0.0.0.0'
+    with a token, every worker then first sends {op: hello, token};
+    any other host than loopback without a token is refused
+
+    '''
+
+    def __init__(self, mydb, kind, shards, port=9900, host='127.0.0.1',
+            tasktimeout=3600, token=None):
+        if token is None and not self._loopback(host):
+            raise MyExcept('Error: Coordinator on %s needs a token.' %(host))
+        self.mydb = mydb
+        self.kind = kind
+        self.tasktimeout = tasktimeout
+        self.token = token
+        self.dropped = 0
+        self.pending = queue.Queue()
+        for i, shard in enumerate(shards):
+            self.pending.put((i, list(shard)))
+        self.remaining = len(shards)
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+        self.reassigned = 0
+
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                coordinator._serve(self.connection, self.rfile, self.wfile)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    @staticmethod
+    def _loopback(host):
+        try:
+            return ipaddress.ip_address(
+                socket.gethostbyname(host)).is_loopback
+        except (OSError, ValueError):
+            return False
+
+    @staticmethod
+    def shard_subnets(netlist, prefix=24):
+        '''
+        one shard per network, larger networks split into /prefix
+
+        '''
+
+        shards = []
+        for net in netlist:
+            if '/' in net and int(net.split('/')[1]) < prefix:
+                for subnet in ipaddress.IPv4Network(net, strict=False).subnets(
+                        new_prefix=prefix):
+                    shards.append([str(subnet)])
+            else:
+                shards.append([net])
+        return shards
+
+    @staticmethod
+    def shard_hash(targets, count):
+        '''
+        count shards of ip by a hash of the ip, spreads every subnet
+
+        '''
+
+        shards = [[] for _ in range(count)]
+        for ip in targets:
+            shards[zlib.crc32(ip.encode()) % count].append(ip)
+        return [shard for shard in shards if len(shard) > 0]
+
+    def run(self, size=200, interval=5):
+        '''
+        serve workers until every shard is done, writing results meanwhile
+        blocking, the only thread using mydb
+        return: number of records written
+
+        '''
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        hosts = BatchWriter(self.mydb.bulk_update_hosts, size, interval)
+        services = BatchWriter(self.mydb.bulk_update_services, size, interval)
+        count = 0
+        try:
+            while True:
+                with self.lock:
+                    if self.remaining == 0 and self.results.empty():
+                        break
+                try:
+                    record = self.results.get(timeout=1)
+                except queue.Empty:
+                    hosts.add(None) #flush by interval while idle
+                    services.add(None)
+                    continue
+                if record.get('portid') is None:
+                    hosts.add(record)
+                else:
+                    services.add(record)
+                count += 1
+        finally:
+            hosts.flush()
+            services.flush()
+            self.server.shutdown()
+            self.server.server_close()
+        return count
+
+    def _serve(self, conn, rfile, wfile):
+        '''
+        feed one worker connection shard by shard
+
+        '''
+
+        conn.settimeout(self.tasktimeout)
+        if self.token is not None:
+            try:
+                hello = json.loads(rfile.readline())
+                token = str(hello.get('token'))
+            except Exception:
+                token = ''
+            if not hmac.compare_digest(token.encode(), self.token.encode()):
+                print('Refused worker %s' %(conn.getpeername()[0]))
+                return
+        while True:
+            task = self._next()
+            if task is None:
+                self._send(wfile, {'op': 'bye'})
+                return
+            taskid, targets = task
+            shard = Targets(targets)
+            try:
+                self._send(wfile, {'op': 'task', 'id': taskid,
+                    'kind': self.kind, 'targets': targets})
+                while True:
+                    line = rfile.readline()
+                    if not line:
+                        raise EOFError()
+                    message = json.loads(line)
+                    if message.get('id') != taskid:
+                        continue
+                    if message['op'] == 'record':
+                        if self._inshard(message.get('record'), shard):
+                            self.results.put(message['record'])
+                        else:
+                            with self.lock:
+                                self.dropped += 1
+                    elif message['op'] == 'done':
+                        break
+            except Exception:
+                self.pending.put(task) #worker failed, give shard to another
+                with self.lock:
+                    self.reassigned += 1
+                print('Reassigned shard %d' %(taskid))
+                return
+            with self.lock:
+                self.remaining -= 1
+            print('Done with shard %d, %d left' %(taskid, self.remaining))
+
+    def _inshard(self, record, shard):
+        '''
+        True if record is a dict whose ip is one of the shard targets
+
+        '''
+
+        try:
+            return type(record) is dict and record.get('ip') in shard
+        except ValueError: #not an ip
+            return False
+
+    def _next(self):
+        '''
+        next pending shard, None once all are done
+        waits while shards are out, as they may still come back
+
+        '''
+
+        while True:
+            try:
+                return self.pending.get(timeout=1)
+            except queue.Empty:
+                with self.lock:
+                    if self.remaining == 0:
+                        return None
+
+    def _send(self, wfile, message):
+        wfile.write((json.dumps(message) + '\n').encode())
+        wfile.flush()
+
+
+class Worker:
+    '''
+    run shards from a Coordinator with the local Ping and Scanner
+    kind      shard targets          probe
+    ping      networks or ips        AsyncRunner ping
+    discover  networks               Scanner().discover
+    os        networks or ips        AsyncRunner os, groupsize per nmap
+    ports     networks or ips        AsyncRunner ports
+
+    '''
+
+    def __init__(self, concurrency=None, groupsize=16, method='icmp',
+            token=None):
+        '''
+        token: shared with the Coordinator, if it asks for one
+
+        '''
+
+        self.runner = AsyncRunner(concurrency)
+        self.groupsize = groupsize
+        self.method = method
+        self.token = token
+
+    def run(self, host='127.0.0.1', port=9900, retry=30):
+        '''
+        connect and work until the coordinator says bye
+        return: number of shards done
+
+        '''
+
+        deadline = time.time() + retry
+        while True:
+            try:
+                conn = socket.create_connection((host, port))
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise MyExcept('Error: Coordinator is not reachable.')
+                time.sleep(1)
+
+        count = 0
+        with conn:
+            rfile = conn.makefile('rb')
+            wfile = conn.makefile('wb')
+            if self.token is not None:
+                wfile.write((json.dumps({'op': 'hello', 'token': self.token})
+                    + '\n').encode())
+                wfile.flush()
+            for line in rfile:
+                message = json.loads(line)
+                if message['op'] == 'bye':
+                    break
+                self._task(wfile, message)
+                count += 1
+        return count
+
+    def _task(self, wfile, task):
+        def send(record):
+            for rec in (record if type(record) is list else [record]):
+                wfile.write((json.dumps({'op': 'record', 'id': task['id'],
+                    'record': rec}) + '\n').encode())
+            wfile.flush()
+
+        kind, targets = task['kind'], task['targets']
+        if kind == 'discover':
+            if self.runner.scanner is None:
+                self.runner.scanner = Scanner()
+            send(self.runner.scanner.discover(targets, self.method))
+        elif kind == 'os':
+            self.runner.run('os', Targets(targets).batches(self.groupsize),
+                send)
+        else:
+            self.runner.run(kind, Targets(targets), send)
+        wfile.write((json.dumps({'op': 'done', 'id': task['id']}) +
+            '\n').encode())
+        wfile.flush()
+
+##############################################################################
+
+
+class Daemon:
+    '''
+    long-lived probe service for ad-hoc jobs over a local socket
+    one json object per line:
+      client -> daemon  {kind, targets}  kind: ping, os, ports, service
+      daemon -> client  {op: record, record} lines, then {op: done, count}
+    targets: ping, os, ports take a list of ip, service {'ip': [ports]}
+    every kind has its own pool of warm threads, started once, so kinds
+    run side by side each under its own limit; a pool thread makes its
+    Ping and Scanner once and reuses them, tasks only carry targets.
+    records are written to the database as they come
+
+    '''
+
+    LIMITS = {'ping': 64, 'os': 4, 'ports': 8, 'service': 8}
+    GROUP = 16 #ips of one os scan
+
+    local = threading.local() #Ping and Scanner of each pool thread
+
+    def __init__(self, database='hal9000.db', limits=None, owners=None):
+        self.database = database
+        self.owners = owners
+        self.limits = dict(self.LIMITS)
+        self.limits.update(limits or {})
+        self.pools = {}
+        for kind, limit in self.limits.items():
+            self.pools[kind] = multiprocessing.pool.ThreadPool(limit,
+                Daemon._warm)
+        self.done = dict([(kind, 0) for kind in self.limits])
+
+    @staticmethod
+    def _warm():
+        Daemon.local.ping = Ping()
+        Daemon.local.scanner = None #made on the first nmap task
+
+    @staticmethod
+    def _probe(task):
+        '''
+        one task on a pool thread
+        return: list of records
+
+        '''
+
+        kind, target = task
+        if kind == 'ping':
+            result = Daemon.local.ping.win_ping(target)
+            return [] if result is None else [result]
+        if Daemon.local.scanner is None:
+            Daemon.local.scanner = Scanner()
+        scanner = Daemon.local.scanner
+        if kind == 'os':
+            result = scanner.scan_os_batch(target)
+        elif kind == 'ports':
+            result = list(scanner.iter_ports_tcp([target[0]], target[1]))
+        else:
+            result = scanner.scan_services_tcp(target)
+        scanner.take_timedout()
+        return result
+
+    def tasks(self, kind, targets, ports=None):
+        '''
+        cut targets of one job into pool tasks
+
+        '''
+
+        if kind == 'ping':
+            return [(kind, ip) for ip in targets]
+        if kind == 'os':
+            targets = list(targets)
+            return [(kind, targets[i:i + self.GROUP])
+                for i in range(0, len(targets), self.GROUP)]
+        if kind == 'ports':
+            return [(kind, (ip, ports)) for ip in targets]
+        if kind == 'service':
+            return [(kind, {ip: portlist}) for ip, portlist in targets.items()]
+        raise ValueError('unknown kind %s' %(kind))
+
+    def run(self, kind, targets, callback=None, ports=None):
+        '''
+        run one job on the kind's pool, blocking until it is done
+        callback(record) is called as records come, in any order
+        ports: of a ports job, see Scanner.cmd_ports
+        return: number of records
+
+        '''
+
+        mydb = MyDB(self.database, self.owners)
+        write = mydb.bulk_update_hosts if kind in ('ping', 'os') \
+            else mydb.bulk_update_services
+        writer = BatchWriter(write)
+        count = 0
+        try:
+            for result in self.pools[kind].imap_unordered(Daemon._probe,
+                    self.tasks(kind, targets, ports)):
+                writer.add(result)
+                for record in result:
+                    if callback is not None:
+                        callback(record)
+                    count += 1
+        finally:
+            writer.flush()
+            mydb.conn.close()
+        self.done[kind] += count
+        metrics.inc('daemon_records_total', count, kind=kind)
+        return count
+
+    def serve(self, port=9700, host='127.0.0.1'):
+        '''
+        accept jobs on host:port on a daemon thread
+        return: the server
+
+        '''
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        job = json.loads(line)
+                        if job.get('kind') not in daemon.pools:
+                            raise ValueError('unknown kind %s' %(
+                                job.get('kind')))
+                        count = daemon.run(job['kind'], job['targets'],
+                            self.send, job.get('ports'))
+                        self.reply({'op': 'done', 'count': count})
+                    except (ValueError, KeyError, TypeError) as err:
+                        self.reply({'op': 'error', 'error': str(err)})
+
+            def send(self, record):
+                self.reply({'op': 'record', 'record': record})
+
+            def reply(self, message):
+                self.wfile.write((json.dumps(message) + '\n').encode())
+                self.wfile.flush()
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+            pool.join()
+
+##############################################################################
+
+
+class Inventory:
+    '''
+    cached read-only http/json queries of my database for other tools
+        GET /hosts?subnet=&stat=&dept=&port=&service=&after=&limit=
+        GET /services?subnet=&state=&dept=&port=&service=&after=&limit=
+    readers share a pool of read-only connections, so under WAL they
+    never block the scanners; answers are cached by url until the data
+    version (PRAGMA data_version of a watcher connection) moves; ETag is
+    a crc of the body, If-None-Match gets 304 Not Modified
+    keyset pagination: rows come in key order, pass 'next' as after,
+    'ip' for hosts and 'ip,portid,protocol' for services
+
+    '''
+
+    LIMIT = 500
+    MAXLIMIT = 5000
+
+    def __init__(self, database='hal9000.db', poolsize=4, cachesize=256):
+        MyDB(database).conn.close() #tables exist before mode=ro
+        self.uri = 'file:%s?mode=ro' %(urllib.parse.quote(
+            os.path.abspath(database)))
+        self.pool = queue.Queue()
+        for _ in range(poolsize):
+            self.pool.put(self._connect())
+        self.watcher = self._connect()
+        self.lock = threading.Lock()
+        self.dataversion = None
+        self.version = 0
+        self.cache = collections.OrderedDict()
+        self.cachesize = cachesize
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        try:
+            conn = sqlite3.connect(self.uri, uri=True, timeout=30,
+                check_same_thread=False)
+            conn.execute('PRAGMA query_only=1')
+            conn.create_function('ipint', 1, lambda ip: struct.unpack('!I',
+                socket.inet_aton(ip))[0], deterministic=True)
+        except:
+            raise MyExcept('Error: Open %s read-only.' %(self.uri))
+        return conn
+
+    def current(self):
+        '''
+        data version, moves whenever any writer committed since last call
+
+        '''
+
+        with self.lock:
+            dataversion = self.watcher.execute(
+                'PRAGMA data_version').fetchone()[0]
+            if dataversion != self.dataversion:
+                self.dataversion = dataversion
+                self.version += 1
+                self.cache.clear()
+            return self.version
+
+    def get(self, url):
+        '''
+        answer of one GET url, from cache if the data did not move
+        return: (status, etag, body bytes)
+
+        '''
+
+        version = self.current()
+        with self.lock:
+            entry = self.cache.get(url)
+            if entry is not None and entry[0] == version:
+                self.cache.move_to_end(url)
+                self.hits += 1
+                metrics.inc('inventory_cache_total', result='hit')
+                return entry[1:]
+            self.misses += 1
+        metrics.inc('inventory_cache_total', result='miss')
+
+        parts = urllib.parse.urlsplit(url)
+        params = dict(urllib.parse.parse_qsl(parts.query))
+        try:
+            if parts.path == '/hosts':
+                result = self.query('host', params)
+            elif parts.path == '/services':
+                result = self.query('service', params)
+            else:
+                return 404, None, b'{"error": "not found"}'
+        except (ValueError, OSError) as err:
+            return 400, None, json.dumps({'error': str(err)}).encode()
+        body = json.dumps(result).encode()
+        entry = (version, 200, '"%08x"' %(zlib.crc32(body)), body)
+        with self.lock:
+            self.cache[url] = entry
+            if len(self.cache) > self.cachesize:
+                self.cache.popitem(last=False)
+        return entry[1:]
+
+    def query(self, table, params):
+        '''
+        one page of host or service rows
+        params: subnet, stat (hosts), state (services), dept, port,
+        service, after, limit; ValueError on bad ones
+        return: {'records': [..], 'next': key or None}
+
+        '''
+
+        columns = MyDB.HOST_COLUMNS if table == 'host' \
+            else MyDB.SERVICE_COLUMNS
+        keys = MyDB.HOST_KEYS if table == 'host' else MyDB.SERVICE_KEYS
+        where, args = [], []
+        if params.get('subnet'):
+            network = ipaddress.IPv4Network(params['subnet'], strict=False)
+            octets = network.prefixlen // 8 #text prefix narrows by index
+            if octets > 0:
+                prefix = '.'.join(str(network.network_address).split('.')
+                    [:octets]) + '.'
+                where.append('ip>=(?) AND ip<(?)')
+                args.extend([prefix, prefix[:-1] + '/'])
+            where.append('ipint(ip) BETWEEN (?) AND (?)')
+            args.extend([int(network.network_address),
+                int(network.broadcast_address)])
+        for name, col in (('stat', 'stat'), ('state', 'state'),
+                ('dept', 'dept')):
+            if params.get(name) and col in columns:
+                where.append('%s=(?)' %(col))
+                args.append(params[name])
+        for name, col in (('port', 'portid'), ('service', 'servname')):
+            if not params.get(name):
+                continue
+            value = int(params[name]) if name == 'port' else params[name]
+            if table == 'host': #hosts with such an open port
+                where.append('ip IN (SELECT ip FROM service WHERE %s=(?) \
+                    AND state=(?))' %(col))
+                args.extend([value, 'open'])
+            else:
+                where.append('%s=(?)' %(col))
+                args.append(value)
+        if params.get('after'):
+            after = params['after'].split(',')
+            if len(after) != len(keys):
+                raise ValueError('after needs %s' %(','.join(keys)))
+            if table == 'service':
+                after[1] = int(after[1])
+            where.append('(%s)>(%s)' %(','.join(keys),
+                ','.join(['?'] * len(keys))))
+            args.extend(after)
+        limit = min(int(params.get('limit', self.LIMIT)), self.MAXLIMIT)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+
+        sql = 'SELECT %s FROM %s%s ORDER BY %s LIMIT %d' %(
+            ','.join(['"%s"' %(col) for col in columns]), table,
+            ' WHERE ' + ' AND '.join(where) if where else '',
+            ','.join(keys), limit + 1)
+        conn = self.pool.get()
+        try:
+            rows = conn.execute(sql, args).fetchall()
+        except sqlite3.Error as err:
+            raise OSError(str(err))
+        finally:
+            self.pool.put(conn)
+        records = [dict(zip(columns, row)) for row in rows[:limit]]
+        following = None
+        if len(rows) > limit:
+            following = ','.join([str(records[-1][key]) for key in keys])
+        return {'records': records, 'next': following}
+
+    def serve(self, port=9800, host='127.0.0.1'):
+        '''
+        serve get() over http on a daemon thread
+        return: the http server
+
+        '''
+
+        inventory = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, etag, body = inventory.get(self.path)
+                if etag is not None and \
+                        self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                if etag is not None:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
 
 ##############################################################################